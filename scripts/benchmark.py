@@ -0,0 +1,294 @@
+#!/usr/bin/env python3
+"""benchmark.py
+
+Time the plugin's startup, selection, and database hot paths offline, against
+a stand-in bot with a scratch SQLite database, and print the results as JSON
+so runs can be compared between releases:
+
+    python3 scripts/benchmark.py -o before.json
+    python3 scripts/benchmark.py --compare before.json
+
+With ``--compare``, exits non-zero if any benchmark's median got slower than
+the baseline by more than ``--tolerance``.
+
+The database (and everything else) goes on a RAM-backed filesystem
+(``/dev/shm``) where there is one. (A true ``:memory:`` database can't be
+shared with the plugin's background threads, and a shared-cache one fails
+writes under contention instead of waiting.) Pass ``--db-url`` to use some other database, e.g. a
+scratch PostgreSQL database.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+import types
+
+from sqlalchemy import event
+
+from sopel import config as sopel_config, db as sopel_db
+from sopel.tools import SopelMemory
+
+import sopel_waifu
+
+
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+
+class FakeTrigger:
+    """Just enough of :class:`sopel.trigger.Trigger` for the plugin's handlers."""
+
+    def __init__(self, bot, nick, channel, *args):
+        self.nick = bot.db.make_identifier(nick)
+        self.sender = bot.db.make_identifier(channel)
+        self.is_privmsg = not channel.startswith('#')
+        self.admin = self.owner = False
+        self._args = args
+
+    def group(self, n):
+        if n == 2:
+            return ' '.join(self._args) or None
+        if 3 <= n < 3 + len(self._args):
+            return self._args[n - 3]
+        return None
+
+
+def make_bot(homedir, settings=None, db_url=None):
+    """Build a stand-in bot with a real config and a scratch database."""
+    if db_url is None:
+        db_url = 'sqlite:///' + os.path.join(homedir, 'bench.db')
+
+    filename = os.path.join(homedir, 'bench.cfg')
+    lines = [
+        '[core]',
+        'nick = Bench',
+        'owner = owner',
+        'homedir = {}'.format(homedir),
+        'db_url = {}'.format(db_url.replace('%', '%%')),
+        '[waifu]',
+    ]
+    lines.extend('{} = {}'.format(*item) for item in (settings or {}).items())
+    with open(filename, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+    bot = types.SimpleNamespace()
+    bot.config = sopel_config.Config(filename)
+    bot.db = sopel_db.SopelDB(bot.config)
+    bot.memory = SopelMemory()
+    bot.channels = {}
+    bot.nick = bot.db.make_identifier('Bench')
+    bot.say = bot.reply = lambda *args, **kwargs: None
+    return bot
+
+
+class QueryCounter:
+    """Counts SQL statements sent by an engine, from any thread."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+def summarize(samples, queries=None):
+    """Reduce a list of durations (in seconds) to comparable statistics."""
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, round(p * (len(ordered) - 1)))]
+
+    result = {
+        'n': len(ordered),
+        'mean_ms': sum(ordered) / len(ordered) * 1000,
+        'p50_ms': percentile(0.50) * 1000,
+        'p95_ms': percentile(0.95) * 1000,
+        'p99_ms': percentile(0.99) * 1000,
+        'max_ms': ordered[-1] * 1000,
+    }
+    if queries is not None:
+        result['queries_per_call'] = queries / len(ordered)
+    return result
+
+
+def timed(func, iterations, counter=None):
+    samples = []
+    before = counter.count if counter else 0
+    for i in range(iterations):
+        start = time.perf_counter()
+        func(i)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples, counter.count - before if counter else None)
+
+
+def write_synthetic_list(filename, size, per_franchise=20):
+    """Write a plain-JSON waifu list with ``size`` distinct characters."""
+    with open(filename, 'w') as file:
+        file.write('{\n')
+        franchises = range((size + per_franchise - 1) // per_franchise)
+        for f in franchises:
+            count = min(per_franchise, size - f * per_franchise)
+            names = ', '.join(
+                '"Character {} {}"'.format(f, c) for c in range(count))
+            file.write('"Franchise {}": [{}]{}\n'.format(
+                f, names, ',' if f < len(franchises) - 1 else ''))
+        file.write('}\n')
+
+
+def bench_load(size, workdir, db_url=None):
+    """Time a cold and a warm (cached) ``setup()``."""
+    settings = {}
+    if size:
+        settings = {
+            'json_path': os.path.join(workdir, 'synthetic-{}.json5'.format(size)),
+            'json_mode': 'replace',
+        }
+        write_synthetic_list(settings['json_path'], size)
+
+    homedir = tempfile.mkdtemp(dir=workdir)
+    bot = make_bot(homedir, settings, db_url)
+    results = {}
+    for phase in ('cold', 'warm'):
+        start = time.perf_counter()
+        sopel_waifu.setup(bot)
+        results[phase] = summarize([time.perf_counter() - start])
+        results['entries'] = len(bot.memory[sopel_waifu.WAIFU_LIST_KEY])
+        sopel_waifu.shutdown(bot)
+
+    return results
+
+
+def bench_handlers(workdir, iterations, db_url=None, channels=10, users=20):
+    """Time the selection and DB-backed command paths end to end."""
+    bot = make_bot(tempfile.mkdtemp(dir=workdir), db_url=db_url)
+    sopel_waifu.setup(bot)
+    counter = QueryCounter(bot.db.engine)
+    rng = random.Random(0)
+
+    channel_names = ['#bench{}'.format(c) for c in range(channels)]
+    nicks = ['user{}'.format(u) for u in range(users)]
+    for channel in channel_names:
+        bot.channels[bot.db.make_identifier(channel)] = types.SimpleNamespace(
+            users={bot.db.make_identifier(nick): None for nick in nicks})
+
+    def trigger(*args):
+        return FakeTrigger(bot, rng.choice(nicks), rng.choice(channel_names), *args)
+
+    waifus = bot.memory[sopel_waifu.WAIFU_LIST_KEY]
+    selector = bot.memory[sopel_waifu.SELECTOR_KEY]
+    results = {
+        'select_one': timed(
+            lambda i: selector.choice_index(waifus, rng.choice(channel_names)),
+            iterations),
+        'select_three': timed(
+            lambda i: selector.sample_indices(waifus, rng.choice(channel_names), 3),
+            iterations),
+        'waifu': timed(
+            lambda i: sopel_waifu.waifu(bot, trigger()), iterations, counter),
+        'fmk': timed(
+            lambda i: sopel_waifu.fmk(bot, trigger()), iterations, counter),
+        'lastwaifu': timed(
+            lambda i: sopel_waifu.last_waifu(bot, trigger(rng.choice(nicks))),
+            iterations, counter),
+    }
+
+    def fight(i):
+        challenger, defender = rng.sample(nicks, 2)
+        sopel_waifu.waifu_fight(bot, FakeTrigger(
+            bot, challenger, rng.choice(channel_names), defender))
+
+    results['wifight'] = timed(fight, iterations, counter)
+
+    sopel_waifu.shutdown(bot)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """List benchmarks whose median is slower than ``baseline`` allows."""
+    regressions = []
+
+    def walk(new, old, path):
+        if not isinstance(new, dict) or not isinstance(old, dict):
+            return
+        if 'p50_ms' in new and 'p50_ms' in old:
+            if new['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+                regressions.append('{}: p50 {:.3f} ms -> {:.3f} ms'.format(
+                    '.'.join(path), old['p50_ms'], new['p50_ms']))
+            return
+        for key in new.keys() & old.keys():
+            walk(new[key], old[key], path + [key])
+
+    walk(results, baseline, [])
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument(
+        '--sizes', default='100000,1000000',
+        help='comma-separated synthetic list sizes to load (default: %(default)s)')
+    parser.add_argument(
+        '--skip-load', action='store_true', help="don't run the load benchmarks")
+    parser.add_argument(
+        '-n', '--iterations', type=int, default=2000,
+        help='calls per handler benchmark (default: %(default)s)')
+    parser.add_argument(
+        '--db-url',
+        help='database to use instead of a scratch SQLite file '
+             '(on /dev/shm where available)')
+    parser.add_argument(
+        '-o', '--output', help='write results to this file instead of stdout')
+    parser.add_argument(
+        '--compare', metavar='BASELINE', help='results file from an earlier run')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.25,
+        help='allowed median slowdown vs. the baseline (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(
+        prefix='waifu-bench-', dir=SCRATCH_DIR,
+    ) as workdir:
+        results = {
+            'meta': {
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'iterations': args.iterations,
+                'database': 'scratch-sqlite' if args.db_url is None else 'custom',
+            },
+        }
+        if not args.skip_load:
+            results['load'] = {'bundled': bench_load(0, workdir, args.db_url)}
+            for size in filter(None, args.sizes.split(',')):
+                results['load'][size] = bench_load(
+                    int(size), workdir, args.db_url)
+        results['handlers'] = bench_handlers(
+            workdir, args.iterations, args.db_url)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+    else:
+        print(output)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print('Regression: {} ❌'.format(regression), file=sys.stderr)
+        if regressions:
+            return 1
+        print('No regressions beyond tolerance ✅', file=sys.stderr)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
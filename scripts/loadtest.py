@@ -0,0 +1,388 @@
+#!/usr/bin/env python3
+"""loadtest.py
+
+Simulate busy channels hammering the plugin from many threads at once, the
+way Sopel's dispatcher would, and report throughput, latency, contention,
+any lost updates, and how often the database made writers wait:
+
+    python3 scripts/loadtest.py --channels 20 --users 50 --threads 16 --rate 200
+
+Commands go straight to the real handler functions, with stand-in bot and
+trigger objects (see benchmark.py), against a scratch SQLite database or
+whatever ``--db-url`` points to (e.g. a throwaway PostgreSQL database).
+
+Lost updates are detected by reconciling the database afterward against what
+the generator knows happened: every duel must show up exactly once in the
+winner's wins, the loser's losses, the fight log, and the popularity counts.
+Each ``(channel, nick)`` must also end up holding the waifu that the outcomes
+of its ``.waifu`` picks and duels say it should, in the order the DB saw them.
+
+Database lock errors ("database is locked") are counted apart from other
+errors, along with statements slow enough (``--wait-ms``) to have most likely
+spent their time waiting on another connection's lock.
+"""
+from __future__ import annotations
+
+import argparse
+import collections
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+
+from sqlalchemy import event, func, select
+
+import sopel_waifu
+from sopel_waifu.db import (
+    FightLog, FightRecords, FightStats, WaifuPopularity, catalog_id)
+
+from benchmark import SCRATCH_DIR, FakeTrigger, make_bot, summarize
+
+
+COMMANDS = ('waifu', 'lastwaifu', 'wifight', 'fmk')
+DEFAULT_MIX = 'waifu=4,lastwaifu=3,wifight=2,fmk=1'
+
+
+def parse_mix(text):
+    """Parse ``name=weight,...`` into a dict of command weights."""
+    mix = {}
+    for item in text.split(','):
+        name, _, weight = item.partition('=')
+        if name not in COMMANDS:
+            raise argparse.ArgumentTypeError('Unknown command: {!r}'.format(name))
+        mix[name] = float(weight or 1)
+    return mix
+
+
+class Tally:
+    """Thread-safe counters for things the generator knows happened."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+
+    def add(self, key, amount=1):
+        with self._lock:
+            self.counts[key] += amount
+
+
+class Owners:
+    """Which waifu each ``(channel, nick)`` should hold, by the DB's outcomes.
+
+    Updated from inside the handlers' own locks, so changes to the same nick
+    are recorded in the same order the DB applied them.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.expected = {}
+
+    def kept(self, channel, nick, waifu):
+        waifu_id = None if waifu is None else catalog_id(*waifu)
+        with self._lock:
+            self.expected[channel, nick] = waifu_id
+
+    def dueled(self, channel, challenger, defender, outcome):
+        if not outcome.challenger_won:
+            return
+        with self._lock:
+            self.expected[channel, challenger] = self.expected.get(
+                (channel, defender))
+            self.expected[channel, defender] = None
+
+
+def _is_lock_error(exc):
+    message = str(exc).lower()
+    return 'locked' in message or 'busy' in message
+
+
+class LockWaits:
+    """Counts DB lock errors, and statements that probably waited on a lock.
+
+    SQLite doesn't say how long a statement spent waiting for a lock held by
+    another connection, so any statement taking at least ``threshold``
+    seconds is counted as a wait.
+    """
+
+    def __init__(self, engine, threshold):
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.errors = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        event.listen(engine, 'before_cursor_execute', self._before)
+        event.listen(engine, 'after_cursor_execute', self._after)
+        event.listen(engine, 'handle_error', self._error)
+
+    def _before(self, *args):
+        self._local.start = time.perf_counter()
+
+    def _after(self, *args):
+        elapsed = time.perf_counter() - self._local.start
+        if elapsed < self.threshold:
+            return
+        with self._lock:
+            self.waits += 1
+            self.wait_total += elapsed
+            self.wait_max = max(self.wait_max, elapsed)
+
+    def _error(self, context):
+        if _is_lock_error(context.original_exception):
+            with self._lock:
+                self.errors += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'lock_errors': self.errors,
+                'waits': self.waits,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+            }
+
+
+class LoadTest:
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.args = args
+        self.channels = ['#load{}'.format(c) for c in range(args.channels)]
+        self.nicks = ['user{}'.format(u) for u in range(args.users)]
+        self.mix = args.mix
+        self.samples = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.tally = Tally()
+        self.owners = Owners()
+        self.lock_waits = LockWaits(bot.db.engine, args.wait_ms / 1000)
+        self._lock = threading.Lock()
+
+        for channel in self.channels:
+            bot.channels[bot.db.make_identifier(channel)] = types.SimpleNamespace(
+                users={bot.db.make_identifier(nick): None for nick in self.nicks})
+
+        # count the duels that actually happened, as the DB was told them,
+        # and follow each waifu from owner to owner
+        db = bot.memory[sopel_waifu.DB_KEY]
+        duel = db.duel
+        set_waifu = db.set_waifu
+
+        def counted_duel(challenger, channel, defender, challenger_wins):
+            outcome = duel(challenger, channel, defender, challenger_wins)
+            self.tally.add('duels')
+            self.owners.dueled(channel, challenger, defender, outcome)
+            return outcome
+
+        def tracked_set_waifu(nick, channel, waifu, *args, **kwargs):
+            set_waifu(nick, channel, waifu, *args, **kwargs)
+            self.owners.kept(channel, nick, waifu)
+
+        db.duel = counted_duel
+        db.set_waifu = tracked_set_waifu
+
+    def call(self, command, rng):
+        bot = self.bot
+        channel = rng.choice(self.channels)
+        nick, other = rng.sample(self.nicks, 2)
+
+        if command == 'waifu':
+            handler, trigger = sopel_waifu.waifu, FakeTrigger(bot, nick, channel)
+        elif command == 'lastwaifu':
+            handler = sopel_waifu.last_waifu
+            trigger = FakeTrigger(bot, nick, channel, other)
+        elif command == 'wifight':
+            handler = sopel_waifu.waifu_fight
+            trigger = FakeTrigger(bot, nick, channel, other)
+        else:
+            handler, trigger = sopel_waifu.fmk, FakeTrigger(bot, nick, channel)
+
+        start = time.perf_counter()
+        try:
+            handler(bot, trigger)
+        except Exception as exc:
+            name = type(exc).__name__
+            if _is_lock_error(exc):
+                name += ' (database locked)'
+            with self._lock:
+                self.errors[command, name] += 1
+            return
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self.samples[command].append(elapsed)
+        if command == 'waifu':
+            self.tally.add('rolls')
+            self.tally.add('kept')
+        elif command == 'fmk':
+            self.tally.add('rolls', 3)
+
+    def worker(self, seed, deadline):
+        rng = random.Random(seed)
+        commands = list(self.mix)
+        weights = [self.mix[command] for command in commands]
+        # each thread takes an equal share of the target rate
+        interval = self.args.threads / self.args.rate if self.args.rate else 0
+        next_at = time.perf_counter()
+
+        while (now := time.perf_counter()) < deadline:
+            if interval:
+                if next_at > now:
+                    time.sleep(next_at - now)
+                next_at += interval
+            self.call(rng.choices(commands, weights)[0], rng)
+
+    def run(self):
+        deadline = time.perf_counter() + self.args.duration
+        threads = [
+            threading.Thread(target=self.worker, args=(seed, deadline))
+            for seed in range(self.args.threads)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+
+def reconcile(bot, db, tally, owners):
+    """Compare the database with what the generator saw."""
+    expected = {
+        'wins': tally.counts['duels'],
+        'losses': tally.counts['duels'],
+        'rolls': tally.counts['rolls'],
+        'kept': tally.counts['kept'],
+        'fights': tally.counts['duels'],
+    }
+    queries = {
+        'wins': select(func.sum(FightRecords.wins)),
+        'losses': select(func.sum(FightRecords.losses)),
+        'rolls': select(func.sum(WaifuPopularity.rolls)),
+        'kept': select(func.sum(WaifuPopularity.kept)),
+        'fights': select(func.sum(WaifuPopularity.fights)),
+    }
+    if bot.config.waifu.fight_log:
+        expected['fight_log'] = tally.counts['duels']
+        queries['fight_log'] = select(func.count(FightLog.id))
+    if not bot.config.waifu.popularity:
+        for stat in ('rolls', 'kept', 'fights'):
+            del expected[stat], queries[stat]
+
+    with bot.db.session() as session:
+        checks = {
+            name: {
+                'expected': expected[name],
+                'actual': session.execute(query).scalar() or 0,
+            }
+            for name, query in queries.items()
+        }
+        held = {
+            (row.channel, row.nick_id): row.waifu_id
+            for row in session.execute(
+                select(FightStats.channel, FightStats.nick_id, FightStats.waifu_id))
+        }
+
+    # every nick whose waifu the generator followed must hold just that one;
+    # IDs are looked up the same (cached) way the handlers looked them up
+    matching = sum(
+        held.get((db._channel_slug(channel), db._nick_id(nick))) == waifu_id
+        for (channel, nick), waifu_id in owners.expected.items()
+    )
+    checks['owners'] = {'expected': len(owners.expected), 'actual': matching}
+    return checks
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument(
+        '--users', type=int, default=30, help='nicks, all present in every channel')
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument(
+        '--rate', type=float, default=0,
+        help='target commands per second, in total (default: as fast as possible)')
+    parser.add_argument(
+        '--duration', type=float, default=10, help='seconds (default: %(default)s)')
+    parser.add_argument(
+        '--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+        help='relative command weights (default: %(default)s)'.replace(
+            '%(default)s', DEFAULT_MIX))
+    parser.add_argument(
+        '--db-url', help='database to use instead of scratch SQLite')
+    parser.add_argument(
+        '--wait-ms', type=float, default=20,
+        help='count statements at least this slow as lock waits '
+             '(default: %(default)s)')
+    parser.add_argument(
+        '--set', action='append', default=[], metavar='OPTION=VALUE',
+        help='extra [waifu] config, e.g. --set write_behind=yes (repeatable)')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args(argv)
+
+    settings = dict(option.split('=', 1) for option in args.set)
+
+    with tempfile.TemporaryDirectory(
+        prefix='waifu-load-', dir=SCRATCH_DIR,
+    ) as homedir:
+        bot = make_bot(homedir, settings, args.db_url)
+        sopel_waifu.setup(bot)
+        test = LoadTest(bot, args)
+        elapsed = test.run()
+        locks = bot.memory[sopel_waifu.LOCKS_KEY].stats()
+        db = bot.memory[sopel_waifu.DB_KEY]
+        # flushes every buffer, so the counts can be checked
+        sopel_waifu.shutdown(bot)
+        db_waits = test.lock_waits.stats()
+        checks = reconcile(bot, db, test.tally, test.owners)
+
+    total = sum(map(len, test.samples.values()))
+    results = {
+        'elapsed_s': elapsed,
+        'throughput_per_s': total / elapsed,
+        'commands': {
+            command: dict(
+                summarize(samples), per_s=len(samples) / elapsed)
+            for command, samples in sorted(test.samples.items())
+        },
+        'errors': {
+            '{}: {}'.format(*key): count for key, count in test.errors.items()
+        },
+        'locks': locks,
+        'db_waits': db_waits,
+        'consistency': checks,
+        'lost_updates': sum(
+            abs(check['expected'] - check['actual']) for check in checks.values()
+        ),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print('{:,} commands in {:.1f} s: {:,.1f}/s'.format(
+            total, elapsed, results['throughput_per_s']))
+        for command, stats in results['commands'].items():
+            print('  {:<10} {:>7,} calls {:>8,.1f}/s  p50 {:7.2f}  p95 {:7.2f}  '
+                  'p99 {:7.2f}  max {:8.2f} ms'.format(
+                      command, stats['n'], stats['per_s'], stats['p50_ms'],
+                      stats['p95_ms'], stats['p99_ms'], stats['max_ms']))
+        for error, count in results['errors'].items():
+            print('  error: {} × {:,}'.format(error, count))
+        print('Locks: {:,} taken, {:,} contended, {:.1f} ms waited (max {:.1f} ms)'
+              .format(locks['acquisitions'], locks['contended'],
+                      locks['wait_total'] * 1000, locks['wait_max'] * 1000))
+        print('DB: {:,} lock errors, {:,} waits, {:.1f} ms waited (max {:.1f} ms)'
+              .format(db_waits['lock_errors'], db_waits['waits'],
+                      db_waits['wait_total'] * 1000, db_waits['wait_max'] * 1000))
+        for name, check in checks.items():
+            status = '✅' if check['actual'] == check['expected'] else '❌'
+            print('  {:<10} expected {:>8,}  found {:>8,} {}'.format(
+                name, check['expected'], check['actual'], status))
+
+    return 1 if results['lost_updates'] or results['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,114 +6,561 @@ Copyright 2020-2024 dgw, technobabbl.es
 """
 from __future__ import annotations
 
-import collections
+import datetime
+import functools
 import inspect
 import os
 import random
-
-import json5
+import secrets
+import threading
 
 from sopel import config, formatting, plugin, tools
+from sopel.tools.time import seconds_to_human
 
+from .catalog import (
+    JSON_FORMATS,
+    WaifuCatalog,
+    diff_catalogs,
+    expand_list_path,
+    load_catalog,
+)
 from .db import WaifuDB
+from .errors import NoWaifuError
+from .locks import BackgroundOnce, StripedLock
+from .metrics import Metrics
+from .search import SearchIndex
+from .selection import ChannelSelector, daily_index
 
 
+DAILY_SALT_KEY = 'waifu-daily-salt'
 DB_KEY = 'waifudb'
+# seconds a command waits for a lazily loaded list before giving up
+LAZY_LOAD_WAIT = 2
+LOADER_KEY = 'waifu-loader'
+LOCKS_KEY = 'waifu-locks'
 LOGGER = tools.get_logger('waifu')
+METRICS_KEY = 'waifu-metrics'
 OUTPUT_PREFIX = '[waifu] '
+SEARCH_KEY = 'waifu-search'
+# how many matches to list from `.waifu search` and `.waifu from`
+SEARCH_RESULTS_LIMIT = 10
+# how many characters to list from `.waifu popular`
+POPULAR_SIZE = 5
+SELECTOR_KEY = 'waifu-selector'
 WAIFU_LIST_KEY = 'waifu-list'
+WAIFU_SOURCES_KEY = 'waifu-sources'
 
+_reload_lock = threading.Lock()
 
-def _unescape_formatting(text):
-    # Original waifu-bot on Rizon used $c to escape ^K for colors.
-    # More formatting types can be handled here too, if they'd be useful.
-    return text.replace('$c', formatting.CONTROL_COLOR)
+
+def _absolute_path(value):
+    # unlike FilenameAttribute, which would create an empty file if it
+    # didn't exist, this has to allow directories and glob patterns
+    path = os.path.expanduser(value.strip('"\''))
+    if not os.path.isabs(path):
+        raise ValueError("Value must be an absolute path.")
+    return path
 
 
 class WaifuSection(config.types.StaticSection):
-    json_path = config.types.FilenameAttribute('json_path', relative=False)
-    """JSON file from which to load list of possible waifus."""
+    json_path = config.types.ValidatedAttribute('json_path', parse=_absolute_path)
+    """JSON file, directory of JSON files, or glob, from which to load waifus."""
     json_mode = config.types.ChoiceAttribute('json_mode', ['replace', 'extend'], default='extend')
     """How the file specified by json_path should affect the default list."""
+    json_format = config.types.ChoiceAttribute(
+        'json_format', list(JSON_FORMATS), default='auto')
+    """Whether json_path is strict JSON (fast to load), JSON5, or either."""
+    load_workers = config.types.ValidatedAttribute(
+        'load_workers', parse=int, default=1)
+    """Processes to parse several list files with (1 for none, 0 for one per CPU)."""
     unique_waifus = config.types.BooleanAttribute('unique_waifus', default=True)
     """Whether to deduplicate the waifu list during startup."""
+    cache_catalog = config.types.BooleanAttribute('cache_catalog', default=True)
+    """Whether to cache the compiled waifu list on disk between restarts."""
+    shared_catalog = config.types.ValidatedAttribute(
+        'shared_catalog', parse=_absolute_path)
+    """Packed catalog file to memory-map, shared by bots with the same lists."""
+    weighting = config.types.ChoiceAttribute(
+        'weighting', ['character', 'franchise'], default='character')
+    """Whether each character, or each franchise, is equally likely to be picked."""
+    selection = config.types.ChoiceAttribute(
+        'selection', ['random', 'shuffle'], default='random')
+    """Pick independently at random, or from a per-channel shuffled deck."""
+    repeat_window = config.types.ValidatedAttribute(
+        'repeat_window', parse=int, default=0)
+    """In random selection mode, avoid repeating any of a channel's last N picks."""
+    write_behind = config.types.BooleanAttribute('write_behind', default=False)
+    """Whether to save `.waifu` results in background batches."""
+    write_behind_interval = config.types.ValidatedAttribute(
+        'write_behind_interval', parse=float, default=1.0)
+    """Seconds between background batches, if write_behind is enabled."""
+    write_behind_batch = config.types.ValidatedAttribute(
+        'write_behind_batch', parse=int, default=100)
+    """Pending writes that trigger an early batch, if write_behind is enabled."""
+    row_cache_size = config.types.ValidatedAttribute(
+        'row_cache_size', parse=int, default=1024)
+    """How many users' waifu stats to keep cached in memory (0 to disable)."""
+    row_cache_ttl = config.types.ValidatedAttribute(
+        'row_cache_ttl', parse=float, default=0)
+    """Seconds before cached stats are re-read from the DB (0 for never)."""
+    nick_cache_size = config.types.ValidatedAttribute(
+        'nick_cache_size', parse=int, default=1024)
+    """How many nick IDs and channel names to keep cached (0 to disable)."""
+    fight_log = config.types.BooleanAttribute('fight_log', default=True)
+    """Whether to keep a history of every `.wifight` duel."""
+    fight_log_retention = config.types.ValidatedAttribute(
+        'fight_log_retention', parse=int, default=90)
+    """Days of duel history to keep (0 to keep it forever)."""
+    fight_log_interval = config.types.ValidatedAttribute(
+        'fight_log_interval', parse=float, default=1.0)
+    """Seconds between saving batches of duel history."""
+    fight_log_batch = config.types.ValidatedAttribute(
+        'fight_log_batch', parse=int, default=100)
+    """Unsaved duels that trigger an early batch of duel history."""
+    popularity = config.types.BooleanAttribute('popularity', default=True)
+    """Whether to count how often each character comes up, is kept, and is fought over."""
+    popularity_interval = config.types.ValidatedAttribute(
+        'popularity_interval', parse=float, default=60.0)
+    """Seconds between saving popularity counts (and updating `.waifu popular`)."""
+    lock_stripes = config.types.ValidatedAttribute(
+        'lock_stripes', parse=int, default=64)
+    """How many locks to spread concurrent duels and rerolls across."""
+    instrumentation = config.types.BooleanAttribute('instrumentation', default=False)
+    """Whether to time commands and DB calls (see `.waifuperf`)."""
+    slow_call_ms = config.types.ValidatedAttribute(
+        'slow_call_ms', parse=float, default=500)
+    """With instrumentation on, log any call slower than this (0 to disable)."""
+    metrics_file = config.types.FilenameAttribute('metrics_file', relative=False)
+    """With instrumentation on, keep this file updated in Prometheus text format."""
+    daily_salt = config.types.SecretAttribute('daily_salt')
+    """Secret mixed into `.waifu daily` picks (generated and saved if unset)."""
+    lazy_load = config.types.ChoiceAttribute(
+        'lazy_load', ['no', 'background', 'first_use'], default='no')
+    """Load the waifu list during setup, in the background, or when first needed."""
+    watch_lists = config.types.BooleanAttribute('watch_lists', default=False)
+    """Whether to reload the waifu list automatically when its files change."""
 
 
 def setup(bot):
     # define configuration options stored in Sopel's config file
     bot.config.define_section('waifu', WaifuSection)
 
+    try:
+        _start(bot)
+    except Exception:
+        # Sopel doesn't call shutdown() for a plugin that failed to set up,
+        # which would leave our DB object's threads and hooks (and any
+        # metrics listeners) running
+        shutdown(bot)
+        raise
+
+
+def _start(bot):
+    # optional timing of handlers and DB calls
+    metrics = None
+    if bot.config.waifu.instrumentation:
+        metrics = Metrics(bot.config.waifu.slow_call_ms / 1000)
+        metrics.attach(bot.db.engine)
+        bot.memory[METRICS_KEY] = metrics
+
     # create our custom database object to manage plugin-specific stats
-    bot.memory[DB_KEY] = WaifuDB(bot)
+    bot.memory[DB_KEY] = WaifuDB(
+        bot,
+        write_behind=bot.config.waifu.write_behind,
+        flush_interval=bot.config.waifu.write_behind_interval,
+        flush_size=bot.config.waifu.write_behind_batch,
+        row_cache_size=bot.config.waifu.row_cache_size,
+        row_cache_ttl=bot.config.waifu.row_cache_ttl,
+        nick_cache_size=bot.config.waifu.nick_cache_size,
+        fight_log=bot.config.waifu.fight_log,
+        fight_log_interval=bot.config.waifu.fight_log_interval,
+        fight_log_batch=bot.config.waifu.fight_log_batch,
+        popularity=bot.config.waifu.popularity,
+        popularity_interval=bot.config.waifu.popularity_interval,
+        popular_size=POPULAR_SIZE,
+        metrics=metrics,
+    )
+
+    # per-(channel, nick) locks, so duels and rerolls can't interleave
+    bot.memory[LOCKS_KEY] = StripedLock(max(1, bot.config.waifu.lock_stripes))
+
+    # load and cache the available waifus from configured JSON file(s), now
+    # or (if lazy) whenever something needs them
+    if bot.config.waifu.lazy_load == 'no':
+        _publish_waifus(bot, _load_waifus(bot))
+    else:
+        loader = bot.memory[LOADER_KEY] = BackgroundOnce(
+            functools.partial(_load_waifus_once, bot), 'waifu-list-loader')
+        if bot.config.waifu.lazy_load == 'background':
+            loader.start()
+
+    # set up per-channel selection state, resuming any saved shuffle bags
+    selector = ChannelSelector(
+        bot.config.waifu.selection, bot.config.waifu.repeat_window)
+    if selector.mode == 'shuffle':
+        selector.load_bags(bot.memory[DB_KEY].get_shuffle_bags())
+    bot.memory[SELECTOR_KEY] = selector
+
+    # secret for `.waifu daily`; a generated one is saved so picks survive
+    # restarts
+    if (salt := bot.config.waifu.daily_salt) is None:
+        salt = bot.db.get_plugin_value('waifu', 'daily_salt')
+        if salt is None:
+            salt = secrets.token_hex(16)
+            bot.db.set_plugin_value('waifu', 'daily_salt', salt)
+    bot.memory[DAILY_SALT_KEY] = salt
 
-    # load and cache the available waifus from configured JSON file(s)
+
+def _waifu_sources(bot):
     filenames = [os.path.join(os.path.dirname(__file__), 'waifu.json5')]
     if bot.config.waifu.json_path:
+        shards = expand_list_path(bot.config.waifu.json_path)
         if bot.config.waifu.json_mode == 'replace':
-            filenames = [bot.config.waifu.json_path]
+            filenames = shards
         elif bot.config.waifu.json_mode == 'extend':
-            filenames.append(bot.config.waifu.json_path)
+            filenames.extend(shards)
         else:
             raise config.ConfigurationError('Invalid json_mode.')
 
-    bot.memory[WAIFU_LIST_KEY] = []
+    return filenames
+
+
+def _sources_signature(filenames):
+    signature = []
     for filename in filenames:
-        with open(filename, 'r') as file:
-            data = json5.load(file)
-
-        for franchise, waifus in data.items():
-            bot.memory[WAIFU_LIST_KEY].extend([
-                    _unescape_formatting(
-                        '{waifu}{franchise}'.format(
-                            waifu=waifu,
-                            franchise=' ({})'.format(
-                                formatting.italic(franchise)
-                                if franchise else ''
-                            )
-                        )
-                    )
-                    for waifu in waifus
-                ])
-
-    # deduplicate waifus if configured to do so
-    if bot.config.waifu.unique_waifus:
-        duplicates = [
-            waifu for waifu, count
-            in collections.Counter(bot.memory[WAIFU_LIST_KEY]).items()
-            if count > 1
-        ]
-        count = len(duplicates)
-        LOGGER.info("Found %s duplicate waifu%s: %s",
-                    count, '' if count == 1 else 's', ', '.join(duplicates))
-        bot.memory[WAIFU_LIST_KEY] = list(set(bot.memory[WAIFU_LIST_KEY]))
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            signature.append((filename, None, None))
+        else:
+            signature.append((filename, stat.st_mtime_ns, stat.st_size))
+
+    return tuple(signature)
+
+
+def _load_waifus(bot):
+    filenames = _waifu_sources(bot)
+
+    cache_file = None
+    if bot.config.waifu.cache_catalog:
+        cache_file = os.path.join(
+            bot.config.homedir,
+            '{}.waifu-cache.json'.format(bot.config.basename),
+        )
+
+    # taken *before* loading, so an edit made mid-load still counts as a change
+    bot.memory[WAIFU_SOURCES_KEY] = _sources_signature(filenames)
+    catalog = load_catalog(
+        filenames,
+        unique=bot.config.waifu.unique_waifus,
+        cache_file=cache_file,
+        json_format=bot.config.waifu.json_format,
+        workers=bot.config.waifu.load_workers or os.cpu_count() or 1,
+        packed_file=bot.config.waifu.shared_catalog,
+    )
+    catalog.use_weighting(bot.config.waifu.weighting)
+    return catalog
+
+
+def _publish_waifus(bot, catalog):
+    # stats refer to waifus by their catalog table ID, so every entry needs a
+    # row before anyone can get it
+    bot.memory[DB_KEY].sync_catalog(catalog)
+
+    # the search index keeps its own reference to the catalog it indexes, so
+    # a search racing a reload still gets consistent results; with a shared
+    # catalog, it waits for the first search, so bots that never search
+    # don't keep a private copy of every name
+    bot.memory[SEARCH_KEY] = SearchIndex(
+        catalog, lazy=bot.config.waifu.shared_catalog is not None)
+    bot.memory[WAIFU_LIST_KEY] = catalog
+
+
+def _load_waifus_once(bot):
+    with _reload_lock:
+        # a `.waifureload` might have beaten us to it
+        if WAIFU_LIST_KEY not in bot.memory:
+            _publish_waifus(bot, _load_waifus(bot))
+
+
+def _get_waifus(bot):
+    """Get the waifu list, waiting briefly if it's being loaded lazily.
+
+    Returns ``None`` if it's not ready in time (or failed to load), after
+    telling the user so.
+    """
+    if (waifus := bot.memory.get(WAIFU_LIST_KEY)) is not None:
+        return waifus
+
+    loader = bot.memory[LOADER_KEY]
+    if loader.wait(LAZY_LOAD_WAIT):
+        return bot.memory[WAIFU_LIST_KEY]
+
+    if loader.error is not None:
+        bot.reply("Sorry, the waifu list couldn't be loaded. "
+                  "I'll try again next time.")
+    else:
+        bot.reply("The waifu list is still warming up. Try again in a moment!")
+    return None
+
+
+def reload_waifus(bot):
+    """Rebuild the waifu list from its source files and swap it into place.
+
+    The new catalog is built completely before it replaces the old one, so
+    handlers running concurrently see either the old list or the new one,
+    never something in between. Returns a
+    :class:`~sopel_waifu.catalog.CatalogDiff` describing what changed.
+    """
+    with _reload_lock:
+        old = bot.memory.get(WAIFU_LIST_KEY) or WaifuCatalog()
+        new = _load_waifus(bot)
+        _publish_waifus(bot, new)
+
+    diff = diff_catalogs(old, new)
+    for franchise, names in sorted(diff.added.items()):
+        LOGGER.info("Reload added %d from %r: %s",
+                    len(names), franchise, ', '.join(sorted(names)))
+    for franchise, names in sorted(diff.removed.items()):
+        LOGGER.info("Reload removed %d from %r: %s",
+                    len(names), franchise, ', '.join(sorted(names)))
+
+    return diff
 
 
 def shutdown(bot):
-    # remove our database object
+    # a lazy load still in progress needs the database
+    if (loader := bot.memory.get(LOADER_KEY)) is not None:
+        loader.join()
+
+    # save shuffle bag positions, so channels don't start over from scratch
+    selector = bot.memory.get(SELECTOR_KEY)
+    if selector is not None and selector.mode == 'shuffle':
+        try:
+            bot.memory[DB_KEY].save_shuffle_bags(selector.bag_states())
+        except Exception:
+            LOGGER.exception("Couldn't save shuffle bag state")
+
+    # remove our database object, after writing anything it's holding
     try:
-        del bot.memory[DB_KEY]
+        db = bot.memory.pop(DB_KEY)
     except KeyError:
         pass
+    else:
+        db.close()
+
+    # stop counting queries, leaving final numbers in the metrics file
+    if (metrics := bot.memory.get(METRICS_KEY)) is not None:
+        metrics.detach()
+        write_metrics_file(bot)
 
     # drop our cached waifu list
+    for key in (
+        WAIFU_LIST_KEY, WAIFU_SOURCES_KEY, SELECTOR_KEY, SEARCH_KEY, LOCKS_KEY,
+        METRICS_KEY, LOADER_KEY, DAILY_SALT_KEY,
+    ):
+        try:
+            del bot.memory[key]
+        except KeyError:
+            pass
+
+
+def _instrumented(name):
+    """Time the decorated handler as ``name``, if instrumentation is on.
+
+    Must be the innermost decorator, so Sopel's own go on the wrapper.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(bot, trigger, *args, **kwargs):
+            if (metrics := bot.memory.get(METRICS_KEY)) is None:
+                return function(bot, trigger, *args, **kwargs)
+            with metrics.timer(name):
+                return function(bot, trigger, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _hold_waifus(bot, channel, *nicks):
+    """Lock the waifus of ``nicks`` in ``channel`` against concurrent changes."""
+    channel = bot.db.make_identifier(channel).lower()
+    return bot.memory[LOCKS_KEY].hold(*(
+        (channel, bot.db.make_identifier(nick).lower()) for nick in nicks
+    ))
+
+
+def _list_matches(items, total):
+    """List the (already limited) ``items`` shown out of ``total`` matches."""
+    shown = ', '.join(items)
+    if total > len(items):
+        shown += ', and {:,} more'.format(total - len(items))
+    return shown
+
+
+def _waifu_search(bot, trigger, query):
+    if _get_waifus(bot) is None:
+        return
+
+    index = bot.memory[SEARCH_KEY]
+    indices, fuzzy = index.find_characters(query)
+    if not indices:
+        bot.reply("No waifus match {!r}.".format(query))
+        return
+
+    # only decode the entries that will actually be shown
+    shown = [index.catalog[i] for i in indices[:SEARCH_RESULTS_LIMIT]]
+    if fuzzy:
+        bot.say("No waifus match {!r}. Closest: {}".format(
+            query, _list_matches(shown, len(indices))))
+        return
+
+    bot.say("Found {:,} waifu{}: {}".format(
+        len(indices),
+        '' if len(indices) == 1 else 's',
+        _list_matches(shown, len(indices)),
+    ))
+
+
+def _waifu_from(bot, trigger, query):
+    if _get_waifus(bot) is None:
+        return
+
+    index = bot.memory[SEARCH_KEY]
+    franchises, fuzzy = index.find_franchises(query)
+    if not franchises:
+        bot.reply("No franchises match {!r}.".format(query))
+        return
+
+    if len(franchises) > 1 or fuzzy:
+        bot.say("{} {}".format(
+            'Did you mean:' if fuzzy
+            else '{:,} franchises match:'.format(len(franchises)),
+            _list_matches(
+                [formatting.italic(f) for f in franchises[:SEARCH_RESULTS_LIMIT]],
+                len(franchises)),
+        ))
+        return
+
+    franchise = franchises[0]
+    entries = index.franchise_entries(franchise)
+    names = [index.catalog.entry(i)[0] for i in entries[:SEARCH_RESULTS_LIMIT]]
+    bot.say("{} has {:,} waifu{}: {}".format(
+        formatting.italic(franchise) if franchise else '(No franchise)',
+        len(entries),
+        '' if len(entries) == 1 else 's',
+        _list_matches(names, len(entries)),
+    ))
+
+
+# `.waifu popular` argument -> WaifuPopularity column
+POPULARITY_STATS = {
+    'rolled': 'rolls',
+    'kept': 'kept',
+    'fought': 'fights',
+    'stolen': 'steals',
+}
+
+
+def _waifu_popular(bot, trigger, argument):
+    arg = (argument or 'rolled').lower()
+    if (stat := POPULARITY_STATS.get(arg)) is None:
+        bot.reply("I can rank by: {}.".format(', '.join(POPULARITY_STATS)))
+        return
+
+    if not (top := bot.memory[DB_KEY].get_popular(stat)[:POPULAR_SIZE]):
+        bot.say("No waifus have been {} yet.".format(arg))
+        return
+
+    bot.say("Most {}: {}".format(arg, ' | '.join(
+        "{}. {} ({:,})".format(rank, waifu, count)
+        for rank, (waifu, count) in enumerate(top, 1)
+    )))
+
+
+def _waifu_daily(bot, trigger, argument):
+    if (waifus := _get_waifus(bot)) is None:
+        return
+
+    target = argument or trigger.nick
     try:
-        del bot.memory[WAIFU_LIST_KEY]
-    except KeyError:
-        pass
+        index = daily_index(
+            waifus,
+            bot.memory[DAILY_SALT_KEY],
+            bot.db.make_identifier(trigger.sender).lower(),
+            bot.db.make_identifier(target).lower(),
+        )
+    except IndexError:
+        bot.reply("Sorry, looks like the waifu list is empty!")
+        return
+
+    if argument:
+        msg = "{target}'s waifu of the day is {waifu}"
+    else:
+        msg = '{target}, your waifu of the day is {waifu}'
+
+    bot.say(msg.format(target=target, waifu=waifus[index]))
+
+
+# `.waifu <subcommand> <argument>`; without an argument, the first word is
+# just a nick (for anyone who happens to go by "search", say)
+WAIFU_SUBCOMMANDS = {
+    'search': _waifu_search,
+    'from': _waifu_from,
+}
+# ...except for these, which don't need one
+WAIFU_BARE_SUBCOMMANDS = {
+    'daily': _waifu_daily,
+    'popular': _waifu_popular,
+}
+
+
+@plugin.event('NICK')
+@plugin.unblockable
+def waifu_nick_change(bot, trigger):
+    """Forget cached nick IDs for both sides of a nick change."""
+    if (db := bot.memory.get(DB_KEY)) is None:
+        return
+
+    # for NICK, the old nick is the source and the new one is the only arg
+    db.forget_nick(trigger.nick)
+    db.forget_nick(trigger.args[-1])
 
 
 @plugin.commands('waifu')
 @plugin.output_prefix(OUTPUT_PREFIX)
+@plugin.example('.waifu daily', user_help=True)
+@plugin.example('.waifu popular stolen', user_help=True)
+@plugin.example('.waifu from Neon Genesis Evangelion', user_help=True)
+@plugin.example('.waifu search Asuka', user_help=True)
 @plugin.example('.waifu Peorth', user_help=True)
 @plugin.example('.waifu', user_help=True)
+@_instrumented('waifu')
 def waifu(bot, trigger):
     """Pick a random waifu for yourself or the given nick.
 
     Note: You can't fight over waifus picked for someone else, only waifus
     obtained by someone using this command directly.
+
+    Use `search <text>` to find characters by name, `from <franchise>` to
+    list a franchise's characters, `popular [rolled|kept|fought|stolen]` to
+    see who comes up most, or `daily [nick]` for a waifu that stays the same
+    all day.
     """
+    word = (trigger.group(3) or '').lower()
+    argument = (trigger.group(2) or '').split(None, 1)[1:]
+    if (subcommand := WAIFU_SUBCOMMANDS.get(word)) and argument:
+        subcommand(bot, trigger, argument[0].strip())
+        return
+    if subcommand := WAIFU_BARE_SUBCOMMANDS.get(word):
+        subcommand(bot, trigger, argument[0].strip() if argument else None)
+        return
+
+    if (waifus := _get_waifus(bot)) is None:
+        return
+
     try:
-        choice = random.choice(bot.memory[WAIFU_LIST_KEY])
+        index = bot.memory[SELECTOR_KEY].choice_index(
+            waifus, trigger.sender.lower())
     except IndexError:
         bot.reply("Sorry, looks like the waifu list is empty!")
         return
@@ -124,10 +571,13 @@ def waifu(bot, trigger):
         target = trigger.nick
         msg = '{target}, your waifu is {waifu}'
 
-    bot.say(msg.format(target=target, waifu=choice))
+    bot.say(msg.format(target=target, waifu=waifus[index]))
+    bot.memory[DB_KEY].count_rolls([waifus.entry(index)])
     if target == trigger.nick:
         # don't save a new "last waifu" unless the `target` is the one asking
-        bot.memory[DB_KEY].set_waifu(target, trigger.sender, choice)
+        with _hold_waifus(bot, trigger.sender, target):
+            bot.memory[DB_KEY].set_waifu(
+                target, trigger.sender, waifus.entry(index))
 
 
 @plugin.command('lastwaifu')
@@ -135,6 +585,7 @@ def waifu(bot, trigger):
 @plugin.output_prefix(OUTPUT_PREFIX)
 @plugin.example('.lastwaifu Peorth', user_help=True)
 @plugin.example('.lastwaifu', user_help=True)
+@_instrumented('lastwaifu')
 def last_waifu(bot, trigger):
     """Get a reminder of someone's last waifu, without picking a new one.
 
@@ -176,13 +627,56 @@ else:
     )
 
 
+def _waifu_tournament(bot, trigger):
+    db = bot.memory[DB_KEY]
+    # only lock those who can take part; anyone who loses their waifu before
+    # the tournament starts just drops out of it
+    entrants = db.waifu_holders(
+        trigger.sender, bot.channels[trigger.sender].users)
+
+    result = None
+    if len(entrants) >= 2:
+        with _hold_waifus(bot, trigger.sender, *entrants):
+            result = db.tournament(trigger.sender, entrants)
+
+    if result is None:
+        bot.reply(
+            "A tournament needs at least two people here with waifus to fight over.")
+        return plugin.NOLIMIT
+
+    final = result.matches[-1]
+    runner_up = final.defender if final.challenger_won else final.challenger
+    stolen = sum(match.challenger_won for match in result.matches)
+    bot.say(
+        "{entrants} contenders fought through {rounds} round{s}, and {stolen} "
+        "waifu{s2} changed hands. {champion} beats {runner_up} in the final "
+        "and is crowned champion, with {waifu} at their side!"
+        .format(
+            entrants=result.entrants,
+            rounds=result.rounds,
+            s='' if result.rounds == 1 else 's',
+            stolen=stolen,
+            s2='' if stolen == 1 else 's',
+            champion=result.champion,
+            runner_up=runner_up,
+            waifu=result.waifu,
+        )
+    )
+
+
 @plugin.command('wifight')
 @wifight_limit  # kludge; see above
 @plugin.require_chanmsg
 @plugin.output_prefix('[Waifu Fight!] ')
+@plugin.example('.wifight tournament')
 @plugin.example('.wifight Peorth')
+@_instrumented('wifight')
 def waifu_fight(bot, trigger):
-    """Fight someone for their last waifu."""
+    """Fight someone for their last waifu.
+
+    `.wifight tournament` pits everyone here who has a waifu against each
+    other in a single-elimination bracket.
+    """
     challenger = trigger.nick
 
     if not (target := trigger.group(3)) or target == challenger:
@@ -194,6 +688,10 @@ def waifu_fight(bot, trigger):
         bot.reply("You have to actually challenge {}, smh.".format(who))
         return plugin.NOLIMIT
 
+    # like `.waifu`'s subcommands, this takes precedence over the nick
+    if target.lower() == 'tournament':
+        return _waifu_tournament(bot, trigger)
+
     if not target in bot.channels[trigger.sender].users:
         bot.reply(
             "It isn't fair to steal someone's waifu behind their back, {}."
@@ -202,19 +700,22 @@ def waifu_fight(bot, trigger):
         return plugin.NOLIMIT
 
     db = bot.memory[DB_KEY]
+    challenger_wins = random.choice((challenger, target)) == challenger
 
-    if not (spoils := db.get_waifu(target, trigger.sender)):
+    try:
+        with _hold_waifus(bot, trigger.sender, challenger, target):
+            outcome = db.duel(
+                challenger, trigger.sender, target, challenger_wins)
+    except NoWaifuError:
         bot.reply(
             "Sorry, {} has to have a waifu before you can fight them for her."
             .format(target)
         )
         return plugin.NOLIMIT
 
-    if random.choice((challenger, target)) == challenger:
-        revenge = db.prev_owner_matches(target, trigger.sender, challenger)
-        db.steal_waifu(challenger, trigger.sender, target)
-
-        if revenge:
+    spoils = outcome.waifu
+    if outcome.challenger_won:
+        if outcome.revenge:
             bot.say(
                 "{challenger} wins {waifu} back from {nemesis}! "
                 "There is much rejoicing."
@@ -253,16 +754,142 @@ def waifu_fight(bot, trigger):
         )
 
 
+def _nohighlight(nick):
+    # a zero-width space keeps leaderboards from pinging everyone on them
+    return nick[:1] + '\u200b' + nick[1:]
+
+
+def _describe_record(record):
+    return "{wins:,} win{ws} ({steals:,} stolen, {revenge:,} revenge), {losses:,} loss{ls}".format(
+        wins=record.wins,
+        ws='' if record.wins == 1 else 's',
+        steals=record.steals,
+        revenge=record.revenge_wins,
+        losses=record.losses,
+        ls='' if record.losses == 1 else 'es',
+    )
+
+
+# `.waifutop` argument -> FightRecords column
+LEADERBOARD_STATS = {
+    'wins': 'wins',
+    'steals': 'steals',
+    'revenge': 'revenge_wins',
+    'losses': 'losses',
+}
+LEADERBOARD_SIZE = 5
+
+
+@plugin.command('waifutop')
+@plugin.require_chanmsg
+@plugin.output_prefix('[Waifu Fight!] ')
+@plugin.example('.waifutop steals', user_help=True)
+@plugin.example('.waifutop', user_help=True)
+def waifu_top(bot, trigger):
+    """Show this channel's top duelists by wins, steals, revenge, or losses."""
+    arg = (trigger.group(3) or 'wins').lower()
+    if (stat := LEADERBOARD_STATS.get(arg)) is None:
+        bot.reply("I can rank by: {}.".format(', '.join(LEADERBOARD_STATS)))
+        return
+
+    top = bot.memory[DB_KEY].get_leaderboard(
+        trigger.sender, stat, LEADERBOARD_SIZE)
+    if not top:
+        bot.say("Nobody here has any {} yet.".format(arg))
+        return
+
+    bot.say("Top {}: {}".format(arg, ' | '.join(
+        "{}. {} ({:,})".format(rank, _nohighlight(record.nick), getattr(record, stat))
+        for rank, record in enumerate(top, 1)
+    )))
+
+
+@plugin.command('wifightstats')
+@plugin.require_chanmsg
+@plugin.output_prefix('[Waifu Fight!] ')
+@plugin.example('.wifightstats Peorth', user_help=True)
+@plugin.example('.wifightstats', user_help=True)
+def waifu_fight_stats(bot, trigger):
+    """Show someone's duel record in this channel."""
+    target = trigger.group(3) or trigger.nick
+
+    if (record := bot.memory[DB_KEY].get_fight_record(target, trigger.sender)) is None:
+        bot.say("{} hasn't fought for a waifu here yet.".format(target))
+        return
+
+    bot.say("{}: {}.".format(target, _describe_record(record)))
+
+
+FIGHT_LOG_SIZE = 3
+
+
+@plugin.command('wifightlog')
+@plugin.require_chanmsg
+@plugin.output_prefix('[Waifu Fight!] ')
+@plugin.example('.wifightlog Peorth', user_help=True)
+@plugin.example('.wifightlog', user_help=True)
+def waifu_fight_log(bot, trigger):
+    """Show the latest duels in this channel, or the given nick's."""
+    if not bot.config.waifu.fight_log:
+        bot.reply("Duel history isn't being kept here.")
+        return
+
+    nick = trigger.group(3)
+    fights = bot.memory[DB_KEY].get_fight_log(
+        trigger.sender, nick, FIGHT_LOG_SIZE)
+    if not fights:
+        bot.say("No duels{} on record.".format(
+            ' involving {}'.format(nick) if nick else ''))
+        return
+
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    bot.say(' | '.join(
+        "{ago} ago: {challenger} {verb} {defender}{waifu}".format(
+            ago=seconds_to_human(now - fight.timestamp).replace(' ago', ''),
+            challenger=_nohighlight(fight.challenger),
+            verb={
+                'defended': 'lost to',
+                'stolen': 'beat',
+                'revenge': 'got revenge on',
+            }.get(fight.outcome, fight.outcome),
+            defender=_nohighlight(fight.defender),
+            waifu=' for {}'.format(fight.waifu) if fight.waifu else '',
+        )
+        for fight in fights
+    ))
+
+
+@plugin.interval(60 * 60)
+def prune_fight_log(bot):
+    """Drop duel history older than the configured retention period."""
+    if (
+        not bot.config.waifu.fight_log
+        or bot.config.waifu.fight_log_retention <= 0
+        or (db := bot.memory.get(DB_KEY)) is None
+    ):
+        return
+
+    deleted = db.prune_fight_log(
+        datetime.timedelta(days=bot.config.waifu.fight_log_retention))
+    if deleted:
+        LOGGER.info("Pruned %d old duel(s) from the fight log.", deleted)
+
+
 @plugin.commands('fmk')
 @plugin.output_prefix(OUTPUT_PREFIX)
 @plugin.example('.fmk Peorth', user_help=True)
 @plugin.example('.fmk', user_help=True)
+@_instrumented('fmk')
 def fmk(bot, trigger):
     """Pick random waifus to fuck, marry and kill."""
+    if (waifus := _get_waifus(bot)) is None:
+        return
+
     try:
-        sample = random.sample(bot.memory[WAIFU_LIST_KEY], 3)
+        indices = bot.memory[SELECTOR_KEY].sample_indices(
+            waifus, trigger.sender.lower(), 3)
     except ValueError:
-        condition = 'empty' if len(bot.memory[WAIFU_LIST_KEY]) == 0 else 'too short'
+        condition = 'empty' if len(waifus) == 0 else 'too short'
         bot.reply(
             "Sorry, looks like the waifu list is {condition}!",
             condition=condition,
@@ -273,4 +900,150 @@ def fmk(bot, trigger):
     if target := trigger.group(3):
         msg = target + " will " + msg
 
-    bot.say(msg.format(sample=sample))
+    bot.say(msg.format(sample=[waifus[i] for i in indices]))
+    bot.memory[DB_KEY].count_rolls(map(waifus.entry, indices))
+
+
+@plugin.command('waifureload')
+@plugin.require_admin
+@plugin.output_prefix(OUTPUT_PREFIX)
+def waifu_reload(bot, trigger):
+    """Reload the waifu list(s) without restarting the bot."""
+    try:
+        diff = reload_waifus(bot)
+    except Exception as exc:
+        LOGGER.exception("Failed to reload waifu list")
+        bot.reply("Reload failed; keeping the old list. ({})".format(exc))
+        return
+
+    total = len(bot.memory[WAIFU_LIST_KEY])
+    if not diff:
+        bot.reply("Reloaded {:,} waifus; nothing changed.".format(total))
+        return
+
+    bot.reply(
+        "Reloaded {total:,} waifus: {added:,} added in {added_from:,} "
+        "franchise(s), {removed:,} removed from {removed_from:,}."
+        .format(
+            total=total,
+            added=diff.added_count,
+            added_from=len(diff.added),
+            removed=diff.removed_count,
+            removed_from=len(diff.removed),
+        )
+    )
+
+
+@plugin.interval(15)
+def watch_waifu_lists(bot):
+    """Reload the waifu list(s) if any source file has changed."""
+    if not bot.config.waifu.watch_lists:
+        return
+
+    if _reload_lock.locked():
+        # a reload is already underway
+        return
+
+    if WAIFU_LIST_KEY not in bot.memory:
+        # not loaded yet (see lazy_load); nothing to be out of date
+        return
+
+    filenames = _waifu_sources(bot)
+    if _sources_signature(filenames) == bot.memory.get(WAIFU_SOURCES_KEY):
+        return
+
+    LOGGER.info("Waifu list file(s) changed; reloading.")
+    try:
+        diff = reload_waifus(bot)
+    except Exception:
+        # likely a half-saved file; the signature was already updated, so
+        # this will be retried once the file changes again
+        LOGGER.exception("Automatic waifu list reload failed")
+        return
+
+    LOGGER.info("Automatic reload done: %d added, %d removed.",
+                diff.added_count, diff.removed_count)
+
+
+def _extra_metrics(bot):
+    """Lock and cache counters, as extra samples for the metrics file."""
+    if (locks := bot.memory.get(LOCKS_KEY)) is not None:
+        stats = locks.stats()
+        yield ('waifu_lock_acquisitions_total', 'counter',
+               'Lock stripe acquisitions.', None, stats['acquisitions'])
+        yield ('waifu_lock_contended_total', 'counter',
+               'Lock stripe acquisitions that had to wait.', None, stats['contended'])
+        yield ('waifu_lock_wait_seconds_total', 'counter',
+               'Time spent waiting for lock stripes.', None, stats['wait_total'])
+
+    if (db := bot.memory.get(DB_KEY)) is not None:
+        for cache_name, cache in (
+            ('row', db.row_cache),
+            ('nick', db.nick_cache),
+            ('channel', db.channel_cache),
+        ):
+            stats = cache.stats()
+            labels = {'cache': cache_name}
+            yield ('waifu_cache_hits_total', 'counter',
+                   'Cache hits.', labels, stats['hits'])
+            yield ('waifu_cache_misses_total', 'counter',
+                   'Cache misses.', labels, stats['misses'])
+            yield ('waifu_cache_size', 'gauge',
+                   'Entries currently cached.', labels, stats['size'])
+
+
+@plugin.interval(60)
+def write_metrics_file(bot):
+    """Write current metrics to the configured file, for Prometheus."""
+    if (
+        not bot.config.waifu.metrics_file
+        or (metrics := bot.memory.get(METRICS_KEY)) is None
+    ):
+        return
+
+    try:
+        metrics.write_prometheus(
+            bot.config.waifu.metrics_file, list(_extra_metrics(bot)))
+    except OSError:
+        LOGGER.exception("Couldn't write metrics file")
+
+
+@plugin.command('waifuperf')
+@plugin.require_owner
+@plugin.output_prefix(OUTPUT_PREFIX)
+@plugin.example('.waifuperf db')
+@plugin.example('.waifuperf')
+def waifu_perf(bot, trigger):
+    """Show command latency, or (with `db`) database call latency."""
+    if (metrics := bot.memory.get(METRICS_KEY)) is None:
+        bot.reply("Instrumentation is off; set `instrumentation = yes` to use this.")
+        return
+
+    want_db = (trigger.group(3) or '').lower() == 'db'
+    calls = sorted(
+        (
+            (name, stats) for name, stats in metrics.snapshot().items()
+            if name.startswith('db.') == want_db
+        ),
+        key=lambda item: item[1]['total_ms'],
+        reverse=True,
+    )
+    if not calls:
+        bot.say("Nothing timed yet.")
+        return
+
+    bot.say(' | '.join(
+        "{}: {:,}× p50 {:.1f} p95 {:.1f} p99 {:.1f} ms, {:.1f} SQL/call".format(
+            name.replace('db.', '', 1), stats['count'],
+            stats['p50_ms'], stats['p95_ms'], stats['p99_ms'],
+            stats['queries_per_call'],
+        )
+        for name, stats in calls
+    ))
+
+    if not want_db and (locks := bot.memory.get(LOCKS_KEY)) is not None:
+        stats = locks.stats()
+        bot.say("Locks: {:,} taken, {:,} contended, {:.1f} ms waited (max {:.1f})".format(
+            stats['acquisitions'], stats['contended'],
+            stats['wait_total'] * 1000, stats['wait_max'] * 1000,
+        ))
@@ -0,0 +1,729 @@
+"""sopel-waifu catalog submodule
+
+Part of sopel-waifu. Copyright 2024 dgw, technobabbl.es
+"""
+from __future__ import annotations
+
+import array
+import collections
+import collections.abc
+import concurrent.futures
+import glob
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import struct
+import tempfile
+import typing
+from concurrent.futures.process import BrokenProcessPool
+
+import json5
+
+from sopel import formatting, tools
+
+from .errors import ListLoadError
+from .selection import AliasTable
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+LOGGER = tools.get_logger('waifu')
+
+JSON_FORMATS = ('auto', 'json', 'json5')
+LIST_EXTENSIONS = ('.json', '.json5')
+# starting worker processes costs more than it saves unless there are several
+# files to share out; with just the bundled list and one more, the bundled
+# one dominates anyway
+PARALLEL_MIN_FILES = 3
+
+# bump this whenever the cache file's layout or the flattening logic changes,
+# so stale caches written by older versions are ignored instead of misread
+CACHE_VERSION = 3
+
+# packed catalog files start with this, then a version number (bump it on
+# any layout change) and a 1 written in native byte order, so a file packed
+# on a machine with the other byte order is rebuilt instead of misread
+PACKED_MAGIC = b'WAIFUPAK'
+PACKED_VERSION = 1
+# magic, version, byte order check, cache key, then the number of names,
+# franchises, and entries, and whether there are weights
+_PACKED_HEADER = struct.Struct('=8sII64sQQQQ')
+
+
+def _unescape_formatting(text):
+    # Original waifu-bot on Rizon used $c to escape ^K for colors.
+    # More formatting types can be handled here too, if they'd be useful.
+    return text.replace('$c', formatting.CONTROL_COLOR)
+
+
+def _format_waifu(waifu, franchise):
+    if not franchise:
+        return waifu
+    return '{} ({})'.format(waifu, formatting.italic(franchise))
+
+
+class PackedStrings(collections.abc.Sequence):
+    """Read-only sequence of strings packed into a buffer.
+
+    String ``i`` is the UTF-8 text in ``blob`` from ``offsets[i]`` up to
+    ``offsets[i + 1]``, decoded each time it's accessed, so the buffer can be
+    a shared memory map that no Python strings are kept for.
+    """
+    __slots__ = ('_offsets', '_blob')
+
+    def __init__(self, offsets, blob):
+        self._offsets = offsets
+        self._blob = blob
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('string index out of range')
+        start, end = self._offsets[index], self._offsets[index + 1]
+        return str(self._blob[start:end], 'utf-8', 'surrogatepass')
+
+    def __iter__(self):
+        blob = self._blob
+        start = 0
+        for end in self._offsets[1:]:
+            yield str(blob[start:end], 'utf-8', 'surrogatepass')
+            start = end
+
+    @staticmethod
+    def pack(strings):
+        """Pack ``strings`` into an ``(offsets, blob)`` pair of bytes."""
+        offsets = array.array('Q', [0])
+        blob = bytearray()
+        for string in strings:
+            blob += string.encode('utf-8', 'surrogatepass')
+            offsets.append(len(blob))
+        return offsets.tobytes(), bytes(blob)
+
+
+class WaifuCatalog(collections.abc.Sequence):
+    """Compact, read-only sequence of available waifus.
+
+    Character names and franchise titles are each stored only once, in the
+    ``names`` and ``franchises`` tables; the catalog itself is just a flat
+    array of ``(name_id, franchise_id)`` pairs. Indexing the catalog formats
+    the selected entry on demand, so it can be handed straight to
+    :func:`random.choice` or :func:`random.sample` like a list of strings.
+
+    Each entry may also carry a selection weight (1.0 unless the list says
+    otherwise); :meth:`choice` and :meth:`sample` honor them once
+    :meth:`use_weighting` has been called.
+
+    A catalog can also be packed into a file with :meth:`to_packed` and
+    memory-mapped by :meth:`from_packed`, in which case all of its tables
+    live in pages shared by every process that maps the same file.
+    """
+    __slots__ = ('names', 'franchises', 'weights', 'sampler', '_entries')
+
+    def __init__(self, names=(), franchises=(), entries=(), weights=None):
+        self.names = list(names)
+        self.franchises = list(franchises)
+        self._entries = array.array('I', entries)
+        self.weights = None if weights is None else array.array('d', weights)
+        self.sampler = None
+
+    def __len__(self):
+        return len(self._entries) // 2
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return _format_waifu(*self.entry(index))
+
+    def entry(self, index):
+        """Get the raw ``(name, franchise)`` pair at ``index``."""
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('catalog index out of range')
+        return (
+            self.names[self._entries[2 * index]],
+            self.franchises[self._entries[2 * index + 1]],
+        )
+
+    def entry_ids(self):
+        """Iterate over the raw ``(name_id, franchise_id)`` pairs."""
+        return zip(self._entries[::2], self._entries[1::2])
+
+    def effective_weights(self, mode='character'):
+        """Get each entry's relative selection weight under ``mode``.
+
+        In ``character`` mode, every entry's own weight is used as-is. In
+        ``franchise`` mode, each franchise gets the same total weight, which
+        is shared among its characters in proportion to their own weights.
+
+        Returns ``None`` if every entry is equally likely.
+
+        :raise ValueError: if every entry has weight 0, since then nothing
+                           could ever be picked
+        """
+        if self.weights is not None and self.weights and not any(self.weights):
+            raise ValueError(
+                'Every waifu has weight 0, so none of them can be picked.')
+
+        if mode == 'character':
+            if self.weights is None or len(set(self.weights)) <= 1:
+                # all the same (and, per the above, positive)
+                return None
+            return list(self.weights)
+
+        if mode != 'franchise':
+            raise ValueError('Unknown weighting mode: {!r}'.format(mode))
+
+        weights = self.weights or array.array('d', [1.0]) * len(self)
+        totals = collections.Counter()
+        franchise_ids = self._entries[1::2]
+        for franchise_id, weight in zip(franchise_ids, weights):
+            totals[franchise_id] += weight
+
+        return [
+            weight / totals[franchise_id] if weight else 0.0
+            for franchise_id, weight in zip(franchise_ids, weights)
+        ]
+
+    def use_weighting(self, mode='character'):
+        """Prepare :meth:`choice` and :meth:`sample` to pick using ``mode``.
+
+        See :meth:`effective_weights` for the available modes.
+        """
+        if (weights := self.effective_weights(mode)) is None:
+            self.sampler = None
+        else:
+            self.sampler = AliasTable(weights)
+
+    def choice_index(self, rng=random):
+        """Pick the index of one random entry."""
+        if self.sampler is None:
+            if not self:
+                raise IndexError('Cannot choose from an empty sequence')
+            return rng.randrange(len(self))
+        return self.sampler.pick(rng)
+
+    def sample_indices(self, k, rng=random):
+        """Pick the indices of ``k`` distinct random entries."""
+        if self.sampler is None:
+            return rng.sample(range(len(self)), k)
+        return self.sampler.sample(k, rng)
+
+    def choice(self, rng=random):
+        """Pick one random entry."""
+        return self[self.choice_index(rng)]
+
+    def sample(self, k, rng=random):
+        """Pick ``k`` distinct random entries."""
+        return [self[i] for i in self.sample_indices(k, rng)]
+
+    def by_franchise(self):
+        """Group character names by franchise title."""
+        result = {}
+        for name, franchise in map(self.entry, range(len(self))):
+            result.setdefault(franchise, set()).add(name)
+        return result
+
+    def to_dict(self):
+        """Serialize the catalog into JSON-compatible data."""
+        return {
+            'names': self.names,
+            'franchises': self.franchises,
+            'entries': self._entries.tolist(),
+            'weights': None if self.weights is None else self.weights.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Load a catalog serialized by :meth:`to_dict`."""
+        return cls(
+            data['names'],
+            data['franchises'],
+            data['entries'],
+            data.get('weights'),
+        )
+
+    def to_packed(self, file, key=''):
+        """Write the catalog to ``file`` (binary) for :meth:`from_packed`.
+
+        ``key`` (at most 64 ASCII characters) is stored in the header, to
+        check whether the file is still current without reading the rest.
+        """
+        names = PackedStrings.pack(self.names)
+        franchises = PackedStrings.pack(self.franchises)
+        entries = array.array('I', self._entries)
+        sections = [*names, *franchises, entries.tobytes()]
+        if self.weights is not None:
+            sections.append(array.array('d', self.weights).tobytes())
+
+        file.write(_PACKED_HEADER.pack(
+            PACKED_MAGIC, PACKED_VERSION, 1, key.encode('ascii'),
+            len(self.names), len(self.franchises), len(self),
+            self.weights is not None,
+        ))
+        for section in sections:
+            # 8-byte lengths and alignment keep every table aligned for its
+            # item type when the file is mapped
+            file.write(struct.pack('=Q', len(section)))
+            file.write(section)
+            file.write(b'\0' * (-len(section) % 8))
+
+    @classmethod
+    def from_packed(cls, buffer, key=None):
+        """Load a catalog written by :meth:`to_packed` from ``buffer``.
+
+        ``buffer`` is typically a read-only :class:`mmap.mmap`; the catalog
+        reads straight from it instead of copying anything. Returns ``None``
+        if the buffer was packed by another version or on a machine with a
+        different byte order, or if ``key`` is given and doesn't match.
+        Raises :exc:`ValueError` if the buffer is truncated or corrupt.
+        """
+        view = memoryview(buffer)
+        if len(view) < _PACKED_HEADER.size:
+            raise ValueError('packed catalog is truncated')
+
+        (magic, version, byte_order, stored_key, name_count, franchise_count,
+         entry_count, has_weights) = _PACKED_HEADER.unpack_from(view)
+        if magic != PACKED_MAGIC:
+            raise ValueError('not a packed waifu catalog')
+        if version != PACKED_VERSION or byte_order != 1:
+            return None
+        if key is not None and stored_key.rstrip(b'\0') != key.encode('ascii'):
+            return None
+
+        sections = []
+        position = _PACKED_HEADER.size
+        for _ in range(6 if has_weights else 5):
+            (length,) = struct.unpack_from('=Q', view, position)
+            position += 8
+            if position + length > len(view):
+                raise ValueError('packed catalog is truncated')
+            sections.append(view[position:position + length])
+            position += length + (-length % 8)
+
+        catalog = cls.__new__(cls)
+        catalog.names = PackedStrings(sections[0].cast('Q'), sections[1])
+        catalog.franchises = PackedStrings(sections[2].cast('Q'), sections[3])
+        catalog._entries = sections[4].cast('I')
+        catalog.weights = sections[5].cast('d') if has_weights else None
+        catalog.sampler = None
+
+        if (len(catalog.names) != name_count
+                or len(catalog.franchises) != franchise_count
+                or len(catalog) != entry_count
+                or has_weights and len(catalog.weights) != entry_count):
+            raise ValueError('packed catalog tables have the wrong sizes')
+        return catalog
+
+
+class CatalogDiff(typing.NamedTuple):
+    """Per-franchise differences between two catalogs."""
+    added: dict[str, set[str]]
+    """Newly available characters, by franchise."""
+    removed: dict[str, set[str]]
+    """Characters no longer available, by franchise."""
+
+    @property
+    def added_count(self):
+        return sum(map(len, self.added.values()))
+
+    @property
+    def removed_count(self):
+        return sum(map(len, self.removed.values()))
+
+    def __bool__(self):
+        return bool(self.added or self.removed)
+
+
+def diff_catalogs(old, new):
+    """Compare two catalogs franchise by franchise."""
+    old_groups = old.by_franchise()
+    new_groups = new.by_franchise()
+    added = {}
+    removed = {}
+
+    for franchise in old_groups.keys() | new_groups.keys():
+        before = old_groups.get(franchise, set())
+        after = new_groups.get(franchise, set())
+        if names := after - before:
+            added[franchise] = names
+        if names := before - after:
+            removed[franchise] = names
+
+    return CatalogDiff(added, removed)
+
+
+class CatalogBuilder:
+    """Accumulates waifu entries into a :class:`WaifuCatalog`."""
+
+    def __init__(self, unique=True):
+        self.unique = unique
+        self.duplicates = collections.Counter()
+        self._names = {}
+        self._franchises = {}
+        self._entries = array.array('I')
+        self._weights = array.array('d')
+        self._seen = set()
+
+    def add(self, name, franchise, weight=1.0):
+        """Add ``name`` from ``franchise``, if it isn't a filtered duplicate.
+
+        Duplicates keep the ``weight`` of their first occurrence.
+        """
+        if not 0 <= weight < float('inf'):
+            raise ValueError(
+                'Invalid weight for {!r} ({!r}): {!r}'
+                .format(name, franchise, weight))
+
+        name_id = self._names.setdefault(
+            _unescape_formatting(name), len(self._names))
+        franchise_id = self._franchises.setdefault(
+            _unescape_formatting(franchise), len(self._franchises))
+
+        pair = (name_id, franchise_id)
+        if self.unique:
+            if pair in self._seen:
+                self.duplicates[pair] += 1
+                return
+            self._seen.add(pair)
+
+        self._entries.extend(pair)
+        self._weights.append(weight)
+
+    def add_data(self, data):
+        """Add every entry from a parsed waifu list.
+
+        Each character is either a plain name, or an object with ``name`` and
+        (optional) ``weight`` keys.
+        """
+        for franchise, names in data.items():
+            for name in names:
+                if isinstance(name, dict):
+                    self.add(
+                        name['name'], franchise, float(name.get('weight', 1.0)))
+                else:
+                    self.add(name, franchise)
+
+    def build(self):
+        """Create the finished catalog."""
+        weights = self._weights
+        if all(weight == 1.0 for weight in weights):
+            # don't bother storing weights that are all the default
+            weights = None
+
+        return WaifuCatalog(
+            self._names, self._franchises, self._entries, weights)
+
+    def duplicate_names(self):
+        """Get formatted names of all duplicates filtered out so far."""
+        names = list(self._names)
+        franchises = list(self._franchises)
+        return [
+            _format_waifu(names[name_id], franchises[franchise_id])
+            for name_id, franchise_id in self.duplicates
+        ]
+
+
+def _loads_json(data):
+    """Parse strict JSON from ``data`` (bytes), with orjson if installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def parse_list(filename, json_format='auto'):
+    """Parse one waifu list file.
+
+    With ``json_format`` set to ``json``, the file must be strict JSON, which
+    is parsed many times faster than JSON5; ``json5`` always uses the (slow)
+    JSON5 parser. ``auto`` tries strict JSON first and only falls back to
+    JSON5 if that fails, e.g. because the file has comments or trailing
+    commas.
+    """
+    if json_format not in JSON_FORMATS:
+        raise ValueError('Unknown list format: {!r}'.format(json_format))
+
+    with open(filename, 'rb') as file:
+        data = file.read()
+
+    if json_format != 'json5':
+        try:
+            return _loads_json(data)
+        except ValueError:
+            # orjson's JSONDecodeError is a ValueError too
+            if json_format == 'json':
+                raise
+        LOGGER.debug("%s isn't strict JSON; parsing it as JSON5", filename)
+
+    return json5.loads(data.decode('utf-8'))
+
+
+def expand_list_path(path):
+    """Get the list files ``path`` refers to, in the order to load them.
+
+    ``path`` can be a single file, a directory (meaning every ``.json`` and
+    ``.json5`` file directly inside it), or a glob pattern. Shards are loaded
+    in sorted order of their full paths, so later shards can't change which
+    copy of a duplicate is kept from an earlier one.
+    """
+    if os.path.isdir(path):
+        matches = [
+            os.path.join(path, name) for name in os.listdir(path)
+            if name.endswith(LIST_EXTENSIONS)
+        ]
+    elif glob.has_magic(path):
+        matches = glob.glob(path)
+    else:
+        return [path]
+
+    matches = sorted(match for match in matches if os.path.isfile(match))
+    if not matches:
+        LOGGER.warning("No waifu list files found at %s", path)
+    return matches
+
+
+def _parse_in_pool(filenames, formats, workers):
+    """Parse each file in a separate process; see :func:`_parse_lists`."""
+    # spawned, not forked: the bot's other threads might be holding locks
+    # that a forked child would inherit in their locked state
+    with concurrent.futures.ProcessPoolExecutor(
+        min(workers, len(filenames)),
+        mp_context=multiprocessing.get_context('spawn'),
+    ) as pool:
+        futures = [
+            pool.submit(parse_list, filename, file_format)
+            for filename, file_format in zip(filenames, formats)
+        ]
+        concurrent.futures.wait(futures)
+
+    # a pool that broke down is reported as a whole, not as every shard failing
+    for future in futures:
+        if isinstance(future.exception(), BrokenProcessPool):
+            raise future.exception()
+
+    return futures
+
+
+def _parse_lists(filenames, formats, workers=1):
+    """Parse every file, in parallel if there are enough files and workers.
+
+    Returns the parsed data in the same order as ``filenames``. Every file is
+    attempted, and all failures are raised together as a
+    :class:`~.errors.ListLoadError`.
+    """
+    futures = None
+    if workers > 1 and len(filenames) >= PARALLEL_MIN_FILES:
+        try:
+            futures = _parse_in_pool(filenames, formats, workers)
+        except BrokenProcessPool as exc:
+            LOGGER.warning("Couldn't parse waifu lists in parallel (%s); "
+                           "parsing them one at a time instead.", exc)
+
+    if futures is None:
+        futures = []
+        for filename, file_format in zip(filenames, formats):
+            future = concurrent.futures.Future()
+            try:
+                future.set_result(parse_list(filename, file_format))
+            except Exception as exc:
+                future.set_exception(exc)
+            futures.append(future)
+
+    failures = [
+        (filename, future.exception())
+        for filename, future in zip(filenames, futures)
+        if future.exception() is not None
+    ]
+    for filename, exc in failures:
+        LOGGER.error("Couldn't load waifu list %s: %s", filename, exc)
+    if failures:
+        raise ListLoadError(failures)
+
+    return [future.result() for future in futures]
+
+
+def _cache_key(filenames, unique):
+    """Compute the cache key for a set of source files and settings.
+
+    The key covers the contents of every source file (in load order), so
+    editing, adding, removing, or reordering any list invalidates the cache.
+    """
+    digest = hashlib.sha256()
+    digest.update('v{}:unique={}'.format(CACHE_VERSION, unique).encode())
+
+    for filename in filenames:
+        digest.update(b'\0' + os.path.abspath(filename).encode() + b'\0')
+        with open(filename, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 16), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _read_cache(cache_file, key):
+    try:
+        with open(cache_file, 'rb') as file:
+            data = _loads_json(file.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        LOGGER.warning("Ignoring unreadable waifu cache %s: %s", cache_file, exc)
+        return None
+
+    if not isinstance(data, dict) or data.get('key') != key:
+        return None
+
+    try:
+        return WaifuCatalog.from_dict(data)
+    except (KeyError, TypeError, ValueError, OverflowError) as exc:
+        LOGGER.warning("Ignoring malformed waifu cache %s: %s", cache_file, exc)
+        return None
+
+
+def _write_cache(cache_file, key, catalog):
+    directory = os.path.dirname(os.path.abspath(cache_file))
+    try:
+        # write to a temporary file first and then move it into place, so a
+        # crash mid-write (or a second bot process) can't see a partial cache
+        fd, tmp_name = tempfile.mkstemp(
+            prefix='.waifu-cache.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(dict(catalog.to_dict(), key=key), file)
+            os.replace(tmp_name, cache_file)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+    except OSError as exc:
+        LOGGER.warning("Couldn't write waifu cache %s: %s", cache_file, exc)
+
+
+def _read_packed(packed_file, key):
+    try:
+        with open(packed_file, 'rb') as file:
+            # the map stays valid after the file is closed, and even after
+            # another process replaces the file with a newer one
+            buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as exc:
+        # mmap raises ValueError for an empty file
+        LOGGER.warning("Ignoring unreadable packed catalog %s: %s",
+                       packed_file, exc)
+        return None
+
+    try:
+        return WaifuCatalog.from_packed(buffer, key)
+    except (ValueError, TypeError, struct.error) as exc:
+        LOGGER.warning("Ignoring malformed packed catalog %s: %s",
+                       packed_file, exc)
+        return None
+
+
+def _write_packed(packed_file, key, catalog):
+    directory = os.path.dirname(os.path.abspath(packed_file))
+    try:
+        # same as the cache: never overwrite a file someone might have mapped
+        fd, tmp_name = tempfile.mkstemp(
+            prefix='.waifu-packed.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                catalog.to_packed(file, key)
+            # other bots on the host, possibly running as other users, need
+            # to be able to map it; mkstemp would leave it private
+            os.chmod(tmp_name, 0o644)
+            os.replace(tmp_name, packed_file)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
+    except OSError as exc:
+        LOGGER.warning("Couldn't write packed catalog %s: %s", packed_file, exc)
+        return False
+    return True
+
+
+def build_catalog(filenames, unique=True, json_format='auto', workers=1):
+    """Parse, flatten, and (optionally) deduplicate the given waifu lists.
+
+    See :func:`parse_list` for ``json_format``, which applies to every file
+    except those named ``*.json5`` (like the bundled list); those could need
+    either parser, so they always get ``auto``.
+
+    With more than one of ``workers`` and at least :data:`PARALLEL_MIN_FILES`
+    files, files are parsed in parallel, in separate processes; they're
+    still merged in the order given.
+    """
+    formats = [
+        'auto' if filename.endswith('.json5') else json_format
+        for filename in filenames
+    ]
+
+    builder = CatalogBuilder(unique)
+    for data in _parse_lists(filenames, formats, workers):
+        builder.add_data(data)
+
+    # deduplicate waifus if configured to do so
+    if unique:
+        duplicates = builder.duplicate_names()
+        count = len(duplicates)
+        LOGGER.info("Found %s duplicate waifu%s: %s",
+                    count, '' if count == 1 else 's', ', '.join(duplicates))
+
+    return builder.build()
+
+
+def load_catalog(
+    filenames,
+    unique=True,
+    cache_file=None,
+    json_format='auto',
+    workers=1,
+    packed_file=None,
+):
+    """Load the waifu catalog, using ``cache_file`` if it's current.
+
+    If ``cache_file`` is given and matches the current contents of every file
+    in ``filenames`` (and the ``unique`` setting), the catalog is read straight
+    from it. Otherwise, the catalog is built from the source files and the
+    cache is rewritten for next time.
+
+    ``packed_file`` works the same way (and takes the place of
+    ``cache_file``), but the file is packed by :meth:`WaifuCatalog.to_packed`
+    and memory-mapped, so every process that loads the same lists from it
+    shares a single copy of the catalog.
+    """
+    if packed_file is not None:
+        key = _cache_key(filenames, unique)
+        if (catalog := _read_packed(packed_file, key)) is not None:
+            LOGGER.debug("Mapped %d waifus from %s", len(catalog), packed_file)
+            return catalog
+
+        catalog = build_catalog(filenames, unique, json_format, workers)
+        if _write_packed(packed_file, key, catalog):
+            # map what was just written, so this process shares it too
+            catalog = _read_packed(packed_file, key) or catalog
+        return catalog
+
+    if cache_file is None:
+        return build_catalog(filenames, unique, json_format, workers)
+
+    key = _cache_key(filenames, unique)
+    if (catalog := _read_cache(cache_file, key)) is not None:
+        LOGGER.debug("Loaded %d waifus from cache %s", len(catalog), cache_file)
+        return catalog
+
+    catalog = build_catalog(filenames, unique, json_format, workers)
+    _write_cache(cache_file, key, catalog)
+    return catalog
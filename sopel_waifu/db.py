@@ -4,34 +4,929 @@ Part of sopel-waifu. Copyright 2024 dgw, technobabbl.es
 """
 from __future__ import annotations
 
-from sqlalchemy import Column, ForeignKey, Integer, String
-from sqlalchemy.sql import select
+import abc
+import collections
+import datetime
+import functools
+import hashlib
+import heapq
+import itertools
+import random
+import re
+import sqlite3
+import threading
+import time
+import typing
 
-from sopel.db import BASE, MYSQL_TABLE_ARGS
+from sqlalchemy import (
+    BigInteger,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    inspect,
+    Integer,
+    String,
+    Text,
+)
+from sqlalchemy.dialects import mysql, postgresql, sqlite
+from sqlalchemy.sql import column, delete, func, insert, select, table, text, update
 
+from sopel import tools
+from sopel.db import BASE, MYSQL_TABLE_ARGS, Nicknames
+
+from .catalog import _format_waifu
 from .errors import NoWaifuError
 
 
+LOGGER = tools.get_logger('waifu')
+
+
+class CatalogEntries(BASE):
+    """Known waifus table SQLAlchemy class.
+
+    Each character's ID is a hash of its name and franchise (see
+    :func:`catalog_id`), so it's the same in every database and across list
+    reloads. Rows are only ever added: stats may still refer to characters
+    that have since been dropped from the list.
+    """
+    __tablename__ = 'waifu_catalog'
+    __table_args__ = MYSQL_TABLE_ARGS
+    id = Column(BigInteger, primary_key=True, autoincrement=False)
+    name = Column(Text, nullable=False)
+    franchise = Column(Text, nullable=False)
+
+
+def catalog_id(name, franchise):
+    """Get the stable :class:`CatalogEntries` ID of ``name`` from ``franchise``."""
+    digest = hashlib.sha256(
+        '{}\0{}'.format(name, franchise).encode('utf-8')).digest()
+    # 63 bits, so it fits in a signed BIGINT everywhere
+    return int.from_bytes(digest[:8], 'big') >> 1
+
+
+# how waifus were stored before the catalog table: "Name (^]Franchise^])"
+LEGACY_WAIFU_PATTERN = re.compile(r'(.*) \(\x1d(.*)\x1d\)', re.DOTALL)
+
+
+def _parse_legacy_waifu(waifu):
+    if match := LEGACY_WAIFU_PATTERN.fullmatch(waifu):
+        return match.group(1), match.group(2)
+    return waifu, ''
+
+
 class FightStats(BASE):
     """Waifu fight stats table SQLAlchemy class."""
     __tablename__ = 'waifu_fight_stats'
     __table_args__ = MYSQL_TABLE_ARGS
     nick_id = Column(Integer, ForeignKey('nick_ids.nick_id'), primary_key=True)
     channel = Column(String(255), primary_key=True)
-    waifu = Column(String(255))
+    waifu_id = Column(BigInteger, ForeignKey('waifu_catalog.id'))
     prev_owner_id = Column(Integer, ForeignKey('nick_ids.nick_id'))
     nemesis = Column(String(255))
 
 
+class ShuffleBags(BASE):
+    """Per-channel shuffle bag state table SQLAlchemy class."""
+    __tablename__ = 'waifu_shuffle_bags'
+    __table_args__ = MYSQL_TABLE_ARGS
+    channel = Column(String(255), primary_key=True)
+    size = Column(Integer, nullable=False)
+    seed = Column(BigInteger, nullable=False)
+    position = Column(Integer, nullable=False)
+
+
+class FightRecords(BASE):
+    """Per-channel waifu fight win/loss tallies table SQLAlchemy class.
+
+    Counters are bumped in the same transaction as each duel, so leaderboards
+    are a plain indexed ``ORDER BY`` instead of aggregating history.
+    """
+    __tablename__ = 'waifu_fight_records'
+    __table_args__ = (
+        Index('ix_waifu_fight_records_wins', 'channel', 'wins'),
+        Index('ix_waifu_fight_records_steals', 'channel', 'steals'),
+        MYSQL_TABLE_ARGS,
+    )
+    nick_id = Column(Integer, ForeignKey('nick_ids.nick_id'), primary_key=True)
+    channel = Column(String(255), primary_key=True)
+    wins = Column(Integer, nullable=False, default=0)
+    """Duels won, whether as challenger or defender."""
+    losses = Column(Integer, nullable=False, default=0)
+    """Duels lost, whether as challenger or defender."""
+    steals = Column(Integer, nullable=False, default=0)
+    """Duels won as challenger (i.e. waifus taken from someone else)."""
+    revenge_wins = Column(Integer, nullable=False, default=0)
+    """Steals that took back a waifu the defender had stolen from them."""
+
+
+FIGHT_RECORD_STATS = ('wins', 'losses', 'steals', 'revenge_wins')
+
+
+class FightLog(BASE):
+    """Append-only waifu fight history table SQLAlchemy class."""
+    __tablename__ = 'waifu_fight_log'
+    __table_args__ = (
+        Index('ix_waifu_fight_log_channel', 'channel', 'timestamp'),
+        Index('ix_waifu_fight_log_challenger', 'challenger_id', 'timestamp'),
+        Index('ix_waifu_fight_log_defender', 'defender_id', 'timestamp'),
+        Index('ix_waifu_fight_log_timestamp', 'timestamp'),
+        MYSQL_TABLE_ARGS,
+    )
+    id = Column(Integer, primary_key=True)
+    timestamp = Column(DateTime, nullable=False)
+    """When the duel happened (UTC)."""
+    channel = Column(String(255), nullable=False)
+    challenger_id = Column(Integer, ForeignKey('nick_ids.nick_id'), nullable=False)
+    defender_id = Column(Integer, ForeignKey('nick_ids.nick_id'), nullable=False)
+    waifu_id = Column(BigInteger, ForeignKey('waifu_catalog.id'))
+    outcome = Column(String(16), nullable=False)
+    """One of :data:`FIGHT_OUTCOMES`."""
+
+
+FIGHT_OUTCOMES = ('defended', 'stolen', 'revenge')
+
+
+class WaifuPopularity(BASE):
+    """Per-character popularity counters table SQLAlchemy class."""
+    __tablename__ = 'waifu_popularity'
+    __table_args__ = MYSQL_TABLE_ARGS
+    waifu_id = Column(BigInteger, ForeignKey('waifu_catalog.id'), primary_key=True)
+    rolls = Column(Integer, nullable=False, default=0)
+    """Times picked by ``.waifu`` or ``.fmk``."""
+    kept = Column(Integer, nullable=False, default=0)
+    """Times saved as someone's own waifu."""
+    fights = Column(Integer, nullable=False, default=0)
+    """Times fought over in a ``.wifight`` duel."""
+    steals = Column(Integer, nullable=False, default=0)
+    """Times taken from her owner in a duel."""
+
+
+POPULARITY_STATS = ('rolls', 'kept', 'fights', 'steals')
+
+# one per ranking, in the order WaifuDB._refresh_popular() reads it
+Index('ix_waifu_popularity_rolls',
+      WaifuPopularity.rolls.desc(), WaifuPopularity.waifu_id)
+Index('ix_waifu_popularity_kept',
+      WaifuPopularity.kept.desc(), WaifuPopularity.waifu_id)
+Index('ix_waifu_popularity_fights',
+      WaifuPopularity.fights.desc(), WaifuPopularity.waifu_id)
+Index('ix_waifu_popularity_steals',
+      WaifuPopularity.steals.desc(), WaifuPopularity.waifu_id)
+
+
+class FightLogEntry(typing.NamedTuple):
+    """One duel from the :class:`FightLog`."""
+    timestamp: datetime.datetime
+    challenger: str
+    defender: str
+    waifu: str | None
+    outcome: str
+
+
+class FightRecord(typing.NamedTuple):
+    """One participant's :class:`FightRecords` tallies."""
+    nick: str
+    wins: int
+    losses: int
+    steals: int
+    revenge_wins: int
+
+
+class DuelOutcome(typing.NamedTuple):
+    """Result of a ``.wifight`` duel, as recorded by :meth:`WaifuDB.duel`."""
+    waifu: str
+    """The waifu that was fought over."""
+    challenger_won: bool
+    """Whether the challenger took the waifu from the defender."""
+    revenge: bool
+    """Whether the challenger won back a waifu the defender stole from them."""
+
+
+class TournamentMatch(typing.NamedTuple):
+    """One match from a tournament run by :meth:`WaifuDB.tournament`."""
+    round: int
+    """Which round the match was in, starting from 1."""
+    challenger: str
+    defender: str
+    """The better-seeded participant, whose waifu was at stake."""
+    waifu: str
+    challenger_won: bool
+    revenge: bool
+
+
+class TournamentResult(typing.NamedTuple):
+    """Outcome of :meth:`WaifuDB.tournament`."""
+    champion: str
+    waifu: str
+    """The champion's waifu at the end of the tournament."""
+    entrants: int
+    rounds: int
+    matches: list[TournamentMatch]
+
+
+def bracket_order(size):
+    """List seeds 1 to ``size`` (a power of 2) in single-elimination order.
+
+    Adjacent pairs meet in the first round, and the bracket is arranged so
+    the top two seeds can only meet in the final, the top four only in the
+    semifinals, and so on.
+    """
+    order = [1]
+    while len(order) < size:
+        count = 2 * len(order)
+        order = [s for seed in order for s in (seed, count + 1 - seed)]
+    return order
+
+
+def upsert_statement(dialect, model, rows, keys, increment=()):
+    """Build a native "insert or update" statement for ``rows``, if possible.
+
+    ``rows`` is a list of dicts of column values for ``model``, and ``keys``
+    names the columns of its primary key (or another unique constraint).
+    Every other column in the rows is overwritten if the key already exists,
+    except for columns named in ``increment``, which are added to instead.
+
+    Returns ``None`` if the ``dialect`` has no supported upsert syntax, in
+    which case the caller should fall back to a SELECT and UPDATE/INSERT.
+    """
+    columns = [column for column in rows[0] if column not in keys]
+    table = model.__table__
+
+    def new_value(column, proposed):
+        if column in increment:
+            return table.c[column] + proposed[column]
+        return proposed[column]
+
+    if dialect.name == 'sqlite' and sqlite3.sqlite_version_info >= (3, 24):
+        stmt = sqlite.insert(model).values(rows)
+    elif dialect.name == 'postgresql':
+        stmt = postgresql.insert(model).values(rows)
+    elif dialect.name in ('mysql', 'mariadb'):
+        stmt = mysql.insert(model).values(rows)
+        return stmt.on_duplicate_key_update(
+            {column: new_value(column, stmt.inserted) for column in columns})
+    else:
+        return None
+
+    if not columns:
+        return stmt.on_conflict_do_nothing(index_elements=keys)
+    return stmt.on_conflict_do_update(
+        index_elements=keys,
+        set_={column: new_value(column, stmt.excluded) for column in columns},
+    )
+
+
+class StatsRow(typing.NamedTuple):
+    """The interesting columns of one :class:`FightStats` row."""
+    waifu: str | None
+    prev_owner_id: int | None
+    nemesis: str | None
+
+
+NICK_GROUP_METHODS = (
+    'alias_nick',
+    'unalias_nick',
+    'merge_nick_groups',
+    'forget_nick_group',
+)
+""":class:`~sopel.db.SopelDB` methods that can change a nick's ID."""
+
+_NICK_GROUP_WATCH = '_waifu_nick_group_watch'
+"""Attribute holding a :class:`~sopel.db.SopelDB`'s nick group watchers."""
+
+
+def watch_nick_groups(sopel_db, callback):
+    """Call ``callback()`` after every :data:`NICK_GROUP_METHODS` call.
+
+    The methods are wrapped on the ``sopel_db`` object once, by the first
+    watcher, and put back by the last one to leave. The watchers live on
+    ``sopel_db`` itself, so they can come and go in any order, even across
+    a plugin reload (which starts a new watcher before the old one stops).
+
+    Returns a function that stops watching.
+    """
+    if (watch := getattr(sopel_db, _NICK_GROUP_WATCH, None)) is None:
+        watch = {'callbacks': [], 'saved': {}, 'wrappers': {}}
+        for name in NICK_GROUP_METHODS:
+            watch['saved'][name] = vars(sopel_db).get(name, MISSING)
+            watch['wrappers'][name] = _notify_after(
+                getattr(sopel_db, name), watch['callbacks'])
+            setattr(sopel_db, name, watch['wrappers'][name])
+        setattr(sopel_db, _NICK_GROUP_WATCH, watch)
+
+    watch['callbacks'].append(callback)
+
+    def unwatch():
+        watch['callbacks'].remove(callback)
+        if watch['callbacks'] or getattr(sopel_db, _NICK_GROUP_WATCH) is not watch:
+            return
+
+        for name, wrapper in watch['wrappers'].items():
+            if vars(sopel_db).get(name) is not wrapper:
+                # wrapped again by someone else since; leave theirs alone
+                continue
+            if (saved := watch['saved'][name]) is MISSING:
+                delattr(sopel_db, name)
+            else:
+                setattr(sopel_db, name, saved)
+        delattr(sopel_db, _NICK_GROUP_WATCH)
+
+    return unwatch
+
+
+def _notify_after(method, callbacks):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        finally:
+            for callback in list(callbacks):
+                callback()
+    return wrapper
+
+
+MISSING = object()
+"""Sentinel for "not cached", since ``None`` is a cacheable value."""
+
+
+class LRUCache:
+    """Thread-safe, bounded, least-recently-used cache with optional TTL.
+
+    Entries older than ``ttl`` seconds (if given) count as misses. Hit and
+    miss counts are kept for monitoring.
+
+    Values read from the DB should be stored with :meth:`put_if_current`,
+    which refuses them if the key was written (:meth:`put`) or invalidated
+    since the read began, so a slow reader can't overwrite a newer value
+    with the old one it read. Writes are tracked in a fixed number of
+    per-hash stripes, so unrelated keys occasionally just skip caching.
+    """
+    GENERATION_STRIPES = 256
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl or None
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._generations = [0] * self.GENERATION_STRIPES
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key):
+        """Get the cached value for ``key``, or :data:`MISSING`."""
+        with self._lock:
+            try:
+                value, stored = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return MISSING
+
+            if self.ttl is not None and time.monotonic() - stored > self.ttl:
+                del self._data[key]
+                self.misses += 1
+                return MISSING
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _stripe(self, key):
+        return hash(key) % self.GENERATION_STRIPES
+
+    def generation(self, key):
+        """Take a snapshot of ``key``'s write generation.
+
+        Take it before reading the value from the DB, and pass it to
+        :meth:`put_if_current` along with what was read.
+        """
+        with self._lock:
+            return self._generations[self._stripe(key)]
+
+    def _store(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def put(self, key, value):
+        """Cache a value that was just written, replacing any older one."""
+        with self._lock:
+            self._generations[self._stripe(key)] += 1
+            if self.maxsize > 0:
+                self._store(key, value)
+
+    def put_if_current(self, key, value, generation):
+        """Cache a value read from the DB, unless ``key`` changed meanwhile.
+
+        Returns whether the value was cached.
+        """
+        with self._lock:
+            if self._generations[self._stripe(key)] != generation:
+                return False
+            if self.maxsize > 0:
+                self._store(key, value)
+            return True
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generations[self._stripe(key)] += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generations = [
+                generation + 1 for generation in self._generations]
+            self._data.clear()
+
+    def stats(self):
+        """Get a dict of this cache's size and hit/miss counters."""
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+class WaifuRecord(typing.NamedTuple):
+    """A pending :meth:`WaifuDB.set_waifu` call."""
+    nick: str
+    channel: str
+    waifu: tuple[str, str] | None
+    prev_owner_id: int | None
+    nemesis: str | None
+
+
+class BackgroundBuffer(abc.ABC):
+    """Base for buffers of pending writes flushed by a background thread.
+
+    Batches are handed to ``write`` every ``interval`` seconds, or sooner once
+    ``max_pending`` items are waiting. Subclasses decide how items are held
+    and how a batch is taken from them.
+    """
+    name = 'waifu-buffer'
+
+    def __init__(self, write, interval=1.0, max_pending=100):
+        self._write = write
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._thread = threading.Thread(
+            target=self._run, name=self.name, daemon=True)
+        self._thread.start()
+
+    @abc.abstractmethod
+    def _pending_count(self):
+        """How many items are waiting; called with the lock held."""
+
+    @abc.abstractmethod
+    def _take(self, keys):
+        """Remove and return a batch; called with the lock held."""
+
+    @abc.abstractmethod
+    def _restore(self, batch):
+        """Put back a batch that failed to write; called with the lock held."""
+
+    def _written(self, batch):
+        """Called (with the lock held) after ``batch`` is written, or not."""
+
+    def _batch_items(self, batch):
+        return batch
+
+    def _added(self):
+        if self._pending_count() >= self.max_pending:
+            self._wakeup.set()
+
+    def flush(self, keys=None):
+        """Write pending items (only those for ``keys``, if supported) now."""
+        with self._flush_lock:
+            with self._lock:
+                batch = self._take(keys)
+
+            if not batch:
+                return
+
+            try:
+                self._write(list(self._batch_items(batch)))
+            except Exception:
+                LOGGER.exception(
+                    "Failed to flush %d pending waifu write(s)", len(batch))
+                with self._lock:
+                    self._restore(batch)
+            finally:
+                with self._lock:
+                    self._written(batch)
+
+    def _run(self):
+        while not self._stopping:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def close(self):
+        """Stop the background thread and write anything still pending."""
+        self._stopping = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+
+
+class WriteBehindBuffer(BackgroundBuffer):
+    """Coalescing buffer of pending writes, flushed by a background thread.
+
+    Each key holds only its most recent record, so repeated writes to the same
+    key between flushes cost a single row in the next batch. The buffer is
+    flushed every ``interval`` seconds, or sooner once ``max_pending`` keys
+    are waiting.
+
+    Records stay visible through :meth:`get` until their batch has been
+    committed, so readers never see a gap between the buffer and the DB.
+    """
+    name = 'waifu-write-behind'
+
+    def __init__(self, write, interval=1.0, max_pending=100):
+        self._pending = {}
+        self._inflight = {}
+        super().__init__(write, interval, max_pending)
+
+    def put(self, key, record):
+        with self._lock:
+            # re-insert so the dict stays in order of *latest* write
+            self._pending.pop(key, None)
+            self._pending[key] = record
+            self._added()
+
+    def get(self, key):
+        """Get the newest unflushed record for ``key``, or ``None``."""
+        with self._lock:
+            if (record := self._pending.get(key)) is None:
+                record = self._inflight.get(key)
+            return record
+
+    def _pending_count(self):
+        return len(self._pending)
+
+    def _take(self, keys):
+        if keys is None:
+            batch, self._pending = self._pending, {}
+        else:
+            batch = {
+                key: self._pending.pop(key)
+                for key in keys if key in self._pending
+            }
+        self._inflight = batch
+        return batch
+
+    def _batch_items(self, batch):
+        return batch.values()
+
+    def _restore(self, batch):
+        # put back anything that hasn't been superseded meanwhile
+        for key, record in batch.items():
+            self._pending.setdefault(key, record)
+
+    def _written(self, batch):
+        self._inflight = {}
+
+
+class AppendBuffer(BackgroundBuffer):
+    """Buffer of rows to insert, in order, by a background thread."""
+    name = 'waifu-append'
+
+    def __init__(self, write, interval=1.0, max_pending=100):
+        self._pending = []
+        super().__init__(write, interval, max_pending)
+
+    def put(self, item):
+        with self._lock:
+            self._pending.append(item)
+            self._added()
+
+    def _pending_count(self):
+        return len(self._pending)
+
+    def _take(self, keys):
+        batch, self._pending = self._pending, []
+        return batch
+
+    def _restore(self, batch):
+        self._pending[:0] = batch
+
+
+class CounterBuffer(BackgroundBuffer):
+    """Buffer of counter increments, summed in memory between flushes.
+
+    Counting only takes a short lock around a dict update; each flush hands
+    ``write`` one ``(key, counts)`` pair per key counted since the last one.
+    """
+    name = 'waifu-counters'
+
+    def __init__(self, write, interval=60.0, max_pending=1000):
+        self._pending = collections.defaultdict(collections.Counter)
+        super().__init__(write, interval, max_pending)
+
+    def add(self, key, stat, amount=1):
+        with self._lock:
+            self._pending[key][stat] += amount
+            self._added()
+
+    def _pending_count(self):
+        return len(self._pending)
+
+    def _take(self, keys):
+        batch, self._pending = (
+            self._pending, collections.defaultdict(collections.Counter))
+        return batch
+
+    def _batch_items(self, batch):
+        return batch.items()
+
+    def _restore(self, batch):
+        for key, counts in batch.items():
+            self._pending[key].update(counts)
+
+
+def _utcnow():
+    # naive UTC, which every supported DB stores the same way
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
 class WaifuDB:
     """Plugin-specific database object class.
 
     Methods for mutating waifu-related data need to live *somewhere*. 🤷‍♂️
+
+    Stats rows are kept in an :class:`LRUCache` of ``row_cache_size`` entries
+    (``0`` disables it), refreshed by every write made through this object.
+    If other processes write to the same database, set ``row_cache_ttl`` (in
+    seconds) to bound how stale a cached row can get.
+
+    Nick IDs and channel slugs are cached too (up to ``nick_cache_size`` of
+    each), and the nick cache is cleared whenever nick groups change through
+    the bot's :class:`~sopel.db.SopelDB`.
+
+    If ``fight_log`` is enabled, every duel is also appended to the
+    :class:`FightLog` table, in batches written by an :class:`AppendBuffer`
+    every ``fight_log_interval`` seconds (or once ``fight_log_batch`` duels
+    are waiting).
+
+    If ``popularity`` is enabled, per-character :class:`WaifuPopularity`
+    counts are summed in a :class:`CounterBuffer` and added to the DB every
+    ``popularity_interval`` seconds; the top ``popular_size`` characters by
+    each stat are recomputed after every flush.
+
+    If ``write_behind`` is enabled, :meth:`set_waifu` returns immediately and
+    its writes are batched by a :class:`WriteBehindBuffer`; reads through this
+    object still see them right away. Call :meth:`close` to drain the buffers.
+
+    If a :class:`~.metrics.Metrics` object is given as ``metrics``, every
+    public method (and each background batch write) is timed through it.
     """
 
-    def __init__(self, bot):
+    # the writes done on the buffers' background threads
+    BACKGROUND_WRITES = ('_store_waifus', '_insert_fight_log', '_write_popularity')
+
+    def __init__(
+        self,
+        bot,
+        write_behind=False,
+        flush_interval=1.0,
+        flush_size=100,
+        row_cache_size=1024,
+        row_cache_ttl=None,
+        nick_cache_size=1024,
+        fight_log=True,
+        fight_log_interval=1.0,
+        fight_log_batch=100,
+        popularity=True,
+        popularity_interval=60.0,
+        popular_size=10,
+        metrics=None,
+    ):
+        if metrics is not None:
+            # before creating the buffers, which keep their own references
+            metrics.instrument(self, [
+                name for name, value in vars(WaifuDB).items()
+                if callable(value) and not name.startswith('_')
+                and name != 'close'
+            ] + list(self.BACKGROUND_WRITES), prefix='db.')
+
         self.db = bot.db
         BASE.metadata.create_all(self.db.engine)
+        self._migrate()
+
+        self.row_cache = LRUCache(row_cache_size, row_cache_ttl)
+        self.nick_cache = LRUCache(nick_cache_size)
+        self.channel_cache = LRUCache(nick_cache_size)
+
+        # any change to nick groups can change which ID a nick resolves to
+        self._nick_generation = 0
+        self._unwatch = watch_nick_groups(self.db, self._nick_groups_changed)
+
+        self._buffer = None
+        if write_behind:
+            self._buffer = WriteBehindBuffer(
+                self._store_waifus, flush_interval, flush_size)
+
+        self._fight_log = None
+        if fight_log:
+            self._fight_log = AppendBuffer(
+                self._insert_fight_log, fight_log_interval, fight_log_batch)
+
+        self.popular_size = popular_size
+        self._popular = None
+        self._popularity = None
+        if popularity:
+            self._popularity = CounterBuffer(
+                self._write_popularity, popularity_interval)
+
+    def _migrate(self):
+        """Bring tables created by older versions up to date."""
+        for table_name in (FightStats.__tablename__, FightLog.__tablename__):
+            self._migrate_waifu_column(table_name)
+
+        # create_all() doesn't add indexes to tables that already exist
+        for index in WaifuPopularity.__table__.indexes:
+            index.create(self.db.engine, checkfirst=True)
+
+    def _migrate_waifu_column(self, table_name):
+        """Replace a legacy formatted ``waifu`` column with ``waifu_id``.
+
+        Each distinct legacy value is parsed back into its name and franchise,
+        added to the catalog table, and swapped for its ID. The old column is
+        dropped afterward if the database allows it, or emptied if not; an
+        emptied column means the migration is done.
+        """
+        engine = self.db.engine
+        columns = {
+            info['name'] for info in inspect(engine).get_columns(table_name)}
+        if 'waifu' not in columns:
+            return
+
+        legacy = table(table_name, column('waifu'), column('waifu_id'))
+        if 'waifu_id' in columns:
+            with engine.connect() as connection:
+                pending = connection.execute(
+                    select(legacy.c.waifu)
+                    .where(legacy.c.waifu.is_not(None))
+                    .limit(1)
+                ).first()
+            if pending is None:
+                return
+
+        LOGGER.info("Migrating %s to the waifu catalog table...", table_name)
+
+        with engine.begin() as connection:
+            if 'waifu_id' not in columns:
+                connection.execute(text(
+                    'ALTER TABLE {} ADD COLUMN waifu_id {}'.format(
+                        table_name, BigInteger().compile(dialect=engine.dialect))))
+
+            values = connection.execute(
+                select(legacy.c.waifu).distinct()
+                .where(legacy.c.waifu.is_not(None))
+                .where(legacy.c.waifu_id.is_(None))
+            ).scalars().all()
+            entries = {waifu: _parse_legacy_waifu(waifu) for waifu in values}
+            self._insert_catalog_entries(connection, set(entries.values()))
+
+            for waifu, entry in entries.items():
+                connection.execute(
+                    update(legacy)
+                    .where(legacy.c.waifu == waifu)
+                    .values(waifu_id=catalog_id(*entry))
+                )
+
+        try:
+            with engine.begin() as connection:
+                connection.execute(text(
+                    'ALTER TABLE {} DROP COLUMN waifu'.format(table_name)))
+        except Exception:
+            # e.g. SQLite < 3.35; at least stop storing the strings
+            with engine.begin() as connection:
+                connection.execute(
+                    update(legacy)
+                    .where(legacy.c.waifu.is_not(None))
+                    .values(waifu=None))
+
+        LOGGER.info("Migrated %d distinct waifu(s) in %s.",
+                    len(values), table_name)
+
+    def _insert_catalog_entries(self, connection, entries, chunk_size=300):
+        """Add ``(name, franchise)`` entries that aren't in the catalog table."""
+        wanted = {catalog_id(*entry): entry for entry in entries}
+        if not wanted:
+            return 0
+
+        existing = set(connection.execute(select(CatalogEntries.id)).scalars())
+        rows = [
+            {'id': entry_id, 'name': name, 'franchise': franchise}
+            for entry_id, (name, franchise) in wanted.items()
+            if entry_id not in existing
+        ]
+
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            # another process sharing the DB might be adding the same rows
+            upsert = upsert_statement(
+                connection.dialect, CatalogEntries, chunk, ['id'])
+            if upsert is None:
+                connection.execute(insert(CatalogEntries), chunk)
+            else:
+                connection.execute(upsert)
+
+        return len(rows)
+
+    def sync_catalog(self, catalog):
+        """Make sure every entry in ``catalog`` has a :class:`CatalogEntries` row.
+
+        Returns how many rows were added.
+        """
+        with self.db.engine.begin() as connection:
+            added = self._insert_catalog_entries(
+                connection, set(map(catalog.entry, range(len(catalog)))))
+
+        if added:
+            LOGGER.info("Added %d waifu(s) to the catalog table.", added)
+        return added
+
+    def close(self):
+        """Flush buffered writes and unhook from the bot's DB object.
+
+        Call this before discarding this object.
+        """
+        if self._buffer is not None:
+            self._buffer.close()
+        if self._fight_log is not None:
+            self._fight_log.close()
+        if self._popularity is not None:
+            self._popularity.close()
+
+        if self._unwatch is not None:
+            self._unwatch()
+            self._unwatch = None
+
+    def _nick_groups_changed(self):
+        self._nick_generation += 1
+        self.nick_cache.clear()
+
+    def forget_nick(self, nick):
+        """Drop ``nick``'s cached ID, e.g. because it was just renamed."""
+        self.nick_cache.invalidate(self.db.make_identifier(nick).lower())
+
+    def _nick_id(self, nick, create=False):
+        """Cached :meth:`sopel.db.SopelDB.get_nick_id`.
+
+        Only IDs that exist are cached; unknown nicks are looked up every
+        time, since anything (including other plugins) might create them.
+        """
+        slug = self.db.make_identifier(nick).lower()
+        if (nick_id := self.nick_cache.get(slug)) is not MISSING:
+            return nick_id
+
+        generation = self._nick_generation
+        nick_id = self.db.get_nick_id(nick, create=create)
+        if generation == self._nick_generation:
+            # nick groups didn't change while we were looking
+            self.nick_cache.put(slug, nick_id)
+        return nick_id
+
+    def _channel_slug(self, channel):
+        """Cached :meth:`sopel.db.SopelDB.get_channel_slug`.
+
+        Sopel's version also migrates old case-mapped channel values, which
+        only needs to happen once per channel.
+        """
+        key = self.db.make_identifier(channel).lower()
+        if (slug := self.channel_cache.get(key)) is not MISSING:
+            return slug
+
+        slug = self.db.get_channel_slug(channel)
+        self.channel_cache.put(key, slug)
+        return slug
+
+    def _flush_buffered(self, channel, nicks):
+        """Write out any buffered records for ``nicks`` in ``channel``."""
+        if self._buffer is None:
+            return
+
+        channel_slug = self._channel_slug(channel)
+        keys = []
+        for nick in nicks:
+            try:
+                keys.append((self._nick_id(nick), channel_slug))
+            except ValueError:
+                # nothing can be buffered for a nick without an ID
+                pass
+        self._buffer.flush(keys)
 
     def set_waifu(
         self,
@@ -43,59 +938,157 @@ class WaifuDB:
     ):
         """Record that ``nick`` obtained ``waifu`` in ``channel``.
 
+        The ``waifu`` is a raw ``(name, franchise)`` pair, as returned by
+        :meth:`~.catalog.WaifuCatalog.entry`, and must already be in the
+        catalog table (see :meth:`sync_catalog`).
+
         Optional ``prev_owner_id`` should be given if ``nick`` *won* ``waifu``
         in a duel, to support checking for revenge during future duels.
 
         Optional ``nemesis`` should be given (with ``waifu=None``) if ``nick``
         *lost* their waifu in battle, so ``.lastwaifu`` can show who stole her.
         """
-        nick_id = self.db.get_nick_id(nick, create=True)
-        channel_slug = self.db.get_channel_slug(channel)
+        record = WaifuRecord(nick, channel, waifu, prev_owner_id, nemesis)
+        if waifu is not None:
+            self._count(catalog_id(*waifu), 'kept')
+
+        if self._buffer is not None:
+            # keyed like the stats row, so every nick in a group shares it
+            key = (self._nick_id(nick, create=True), self._channel_slug(channel))
+            self._buffer.put(key, record)
+            return
+
+        self._store_waifus([record])
+
+    def _store_waifus(self, records, chunk_size=150):
+        rows = {}
+        waifus = {}
+        for record in records:
+            nick_id = self._nick_id(record.nick, create=True)
+            channel_slug = self._channel_slug(record.channel)
+
+            # grouped nicks share an ID; the latest record wins
+            rows[nick_id, channel_slug] = {
+                'nick_id': nick_id,
+                'channel': channel_slug,
+                'waifu_id': (
+                    None if record.waifu is None else catalog_id(*record.waifu)),
+                'prev_owner_id': record.prev_owner_id,
+                'nemesis': record.nemesis,
+            }
+            waifus[nick_id, channel_slug] = (
+                None if record.waifu is None else _format_waifu(*record.waifu))
+        rows = list(rows.values())
+
+        try:
+            self._write_stats(rows, chunk_size)
+        except Exception:
+            # no telling what made it in; let the next read ask the DB
+            for row in rows:
+                self.row_cache.invalidate((row['nick_id'], row['channel']))
+            raise
+
+        # the new values are known without asking the DB
+        for row in rows:
+            key = (row['nick_id'], row['channel'])
+            self.row_cache.put(
+                key, StatsRow(waifus[key], row['prev_owner_id'], row['nemesis']))
 
+    def _write_stats(self, rows, chunk_size):
         with self.db.session() as session:
-            result = session.execute(
-                select(FightStats)
-                .where(FightStats.nick_id == nick_id)
-                .where(FightStats.channel == channel_slug)
-            ).scalar_one_or_none()
-
-            # nick+channel combo already known; update it
-            if result:
-                result.waifu = waifu
-                result.prev_owner_id = prev_owner_id
-                result.nemesis = nemesis
-            # nick+channel combo not known; create it
-            else:
-                new_stats = FightStats(
-                    nick_id=nick_id,
-                    channel=channel_slug,
-                    waifu=waifu,
-                    prev_owner_id=prev_owner_id,
-                    nemesis=nemesis,
+            # one round-trip per chunk (kept under SQLite's limit on bound
+            # parameters, however big a write-behind batch grows), and no
+            # race between two INSERTs of the same key
+            upserts = [
+                upsert_statement(
+                    self.db.engine.dialect,
+                    FightStats,
+                    rows[start:start + chunk_size],
+                    ['nick_id', 'channel'],
                 )
-                session.add(new_stats)
+                for start in range(0, len(rows), chunk_size)
+            ]
+            if None not in upserts:
+                for upsert in upserts:
+                    session.execute(upsert)
+                session.commit()
+                return
+
+            for row in rows:
+                result = session.execute(
+                    select(FightStats)
+                    .where(FightStats.nick_id == row['nick_id'])
+                    .where(FightStats.channel == row['channel'])
+                ).scalar_one_or_none()
+
+                # nick+channel combo already known; update it
+                if result:
+                    result.waifu_id = row['waifu_id']
+                    result.prev_owner_id = row['prev_owner_id']
+                    result.nemesis = row['nemesis']
+                # nick+channel combo not known; create it
+                else:
+                    session.add(FightStats(**row))
 
             # whether it's created or just updated, commit the thing
             session.commit()
 
-    def get_waifu(self, nick, channel):
-        """Get ``nick``'s current waifu in ``channel``."""
+    def _get_stats(self, nick, channel):
+        """Get ``nick``'s whole stats row in ``channel``, or ``None``.
+
+        Checked in order: buffered writes, the row cache, and the DB.
+        """
         try:
-            nick_id = self.db.get_nick_id(nick)
+            nick_id = self._nick_id(nick)
         except ValueError:
-            # if they're not in the DB, they can't possibly have a waifu yet
+            # if they're not in the DB, they can't have any stats yet
             return None
 
-        channel_slug = self.db.get_channel_slug(channel)
+        channel_slug = self._channel_slug(channel)
 
+        key = (nick_id, channel_slug)
+        if (
+            self._buffer is not None
+            and (record := self._buffer.get(key)) is not None
+        ):
+            return StatsRow(
+                None if record.waifu is None else _format_waifu(*record.waifu),
+                record.prev_owner_id,
+                record.nemesis,
+            )
+
+        if (row := self.row_cache.get(key)) is not MISSING:
+            return row
+
+        # a write landing while we read makes what we read too old to cache
+        generation = self.row_cache.generation(key)
         with self.db.session() as session:
             result = session.execute(
-                select(FightStats.waifu)
+                select(
+                    CatalogEntries.name,
+                    CatalogEntries.franchise,
+                    FightStats.prev_owner_id,
+                    FightStats.nemesis,
+                )
+                .outerjoin(CatalogEntries, FightStats.waifu_id == CatalogEntries.id)
                 .where(FightStats.nick_id == nick_id)
                 .where(FightStats.channel == channel_slug)
-            ).scalar_one_or_none()
+            ).one_or_none()
 
-            return result
+        row = None
+        if result is not None:
+            name, franchise, prev_owner_id, nemesis = result
+            waifu = None if name is None else _format_waifu(name, franchise)
+            row = StatsRow(waifu, prev_owner_id, nemesis)
+        # "no row" is worth remembering too; most nicks never get a waifu
+        self.row_cache.put_if_current(key, row, generation)
+        return row
+
+    def get_waifu(self, nick, channel):
+        """Get ``nick``'s current waifu in ``channel``."""
+        if (row := self._get_stats(nick, channel)) is None:
+            return None
+        return row.waifu
 
     def clear_waifu(self, nick, channel, thief=None):
         """Clear ``nick``'s waifu in ``channel``.
@@ -109,28 +1102,15 @@ class WaifuDB:
 
         Only set if ``nick`` won their current waifu in a ``.wifight`` duel.
         """
-        try:
-            nick_id = self.db.get_nick_id(nick)
-        except ValueError:
-            # if they're not in the DB, they can't have stolen a waifu yet
+        if (row := self._get_stats(nick, channel)) is None:
             return None
-
-        channel_slug = self.db.get_channel_slug(channel)
-
-        with self.db.session() as session:
-            result = session.execute(
-                select(FightStats.prev_owner_id)
-                .where(FightStats.nick_id == nick_id)
-                .where(FightStats.channel == channel_slug)
-            ).scalar_one_or_none()
-
-            return result
+        return row.prev_owner_id
 
     def prev_owner_matches(self, nick, channel, who):
         """Was the previous owner of ``nick``'s waifu in ``channel`` ``who``?"""
         try:
             return (
-                self.get_prev_owner_id(nick, channel) == self.db.get_nick_id(who)
+                self.get_prev_owner_id(nick, channel) == self._nick_id(who)
             )
         except ValueError:
             # If `who` isn't in the DB, they can't have owned the waifu
@@ -141,32 +1121,674 @@ class WaifuDB:
 
         That is, if they don't have a waifu, who stole her?
         """
+        if (row := self._get_stats(nick, channel)) is None or row.waifu:
+            return None
+        return row.nemesis
+
+    def duel(self, challenger, channel, defender, challenger_wins):
+        """Settle a ``.wifight`` between ``challenger`` and ``defender``.
+
+        Both participants' rows are read (and, where the database supports
+        it, locked with ``SELECT ... FOR UPDATE``) in a single query, and the
+        waifu is transferred if ``challenger_wins``, all in one transaction.
+
+        :raise NoWaifuError: if ``defender`` has no waifu to fight over
+        :return: a :class:`DuelOutcome`
+        """
+        # the duel reads straight from the DB, so it needs these first
+        self._flush_buffered(channel, (challenger, defender))
+
+        try:
+            defender_id = self._nick_id(defender)
+        except ValueError:
+            # if they're not in the DB, they can't possibly have a waifu yet
+            raise NoWaifuError(defender, channel)
+
+        # the challenger's record needs an ID, win or lose
+        challenger_id = self._nick_id(challenger, create=True)
+        channel_slug = self._channel_slug(channel)
+
+        with self.db.session() as session:
+            rows = {
+                row.nick_id: row for row in session.execute(
+                    select(FightStats)
+                    .where(FightStats.channel == channel_slug)
+                    .where(FightStats.nick_id.in_([defender_id, challenger_id]))
+                    .with_for_update()
+                ).scalars()
+            }
+
+            loser = rows.get(defender_id)
+            if loser is None or loser.waifu_id is None:
+                raise NoWaifuError(defender, channel)
+
+            spoils_id = loser.waifu_id
+            entry = session.get(CatalogEntries, spoils_id)
+            spoils = _format_waifu(entry.name, entry.franchise)
+            revenge = loser.prev_owner_id == challenger_id
+
+            if challenger_wins:
+                # drop cached copies before committing, so no reader can
+                # re-cache the old values in between
+                for nick_id in (challenger_id, defender_id):
+                    self.row_cache.invalidate((nick_id, channel_slug))
+
+                if (winner := rows.get(challenger_id)) is None:
+                    winner = FightStats(nick_id=challenger_id, channel=channel_slug)
+                    session.add(winner)
+
+                winner.waifu_id = spoils_id
+                winner.prev_owner_id = defender_id
+                winner.nemesis = None
+
+                loser.waifu_id = None
+                loser.prev_owner_id = None
+                loser.nemesis = challenger
+
+            winner_id, loser_id = (
+                (challenger_id, defender_id) if challenger_wins
+                else (defender_id, challenger_id)
+            )
+            self._tally_records(session, channel_slug, [
+                {
+                    'nick_id': winner_id,
+                    'wins': 1,
+                    'steals': int(challenger_wins),
+                    'revenge_wins': int(challenger_wins and revenge),
+                },
+                {'nick_id': loser_id, 'losses': 1},
+            ])
+
+            session.commit()
+
+        self._count(spoils_id, 'fights')
+        if challenger_wins:
+            self._count(spoils_id, 'steals')
+
+        if self._fight_log is not None:
+            if not challenger_wins:
+                outcome = 'defended'
+            else:
+                outcome = 'revenge' if revenge else 'stolen'
+            self._fight_log.put({
+                'timestamp': _utcnow(),
+                'channel': channel_slug,
+                'challenger_id': challenger_id,
+                'defender_id': defender_id,
+                'waifu_id': spoils_id,
+                'outcome': outcome,
+            })
+
+        if challenger_wins:
+            self.row_cache.put(
+                (challenger_id, channel_slug),
+                StatsRow(spoils, defender_id, None),
+            )
+            self.row_cache.put(
+                (defender_id, channel_slug),
+                StatsRow(None, None, challenger),
+            )
+
+        return DuelOutcome(spoils, challenger_wins, revenge)
+
+    def _select_holders(self, session, channel_slug, nicks, chunk_size=150):
+        """Find which of ``nicks`` have a waifu in a channel.
+
+        ``nicks`` maps nick slugs to nicks. Returns a dict of each holder's
+        :class:`FightStats` row and nick, by nick ID; several aliases of one
+        nick group count once.
+        """
+        slugs = sorted(nicks)
+        holders = {}
+        for start in range(0, len(slugs), chunk_size):
+            for row, slug in session.execute(
+                select(FightStats, Nicknames.slug)
+                .join(Nicknames, Nicknames.nick_id == FightStats.nick_id)
+                .where(FightStats.channel == channel_slug)
+                .where(FightStats.waifu_id.isnot(None))
+                .where(Nicknames.slug.in_(slugs[start:start + chunk_size]))
+                .with_for_update(of=FightStats)
+            ):
+                holders.setdefault(row.nick_id, (row, nicks[slug]))
+        return holders
+
+    def waifu_holders(self, channel, nicks):
+        """Get which of ``nicks`` have a waifu in ``channel``.
+
+        Meant for deciding what to lock before a :meth:`tournament`; the
+        tournament itself checks again.
+        """
+        nicks = {self.db.make_identifier(nick).lower(): nick for nick in nicks}
+        self._flush_buffered(channel, nicks.values())
+
+        with self.db.session() as session:
+            holders = self._select_holders(
+                session, self._channel_slug(channel), nicks)
+            return [nick for _, nick in holders.values()]
+
+    def tournament(self, channel, nicks, rng=random, chunk_size=150):
+        """Run a single-elimination ``.wifight`` tournament in ``channel``.
+
+        Everyone in ``nicks`` who has a waifu in ``channel`` enters, seeded
+        by their duel wins there (ties are drawn at random). Byes go to the
+        top seeds if the entrants don't fill the bracket exactly. Each match
+        is settled exactly like a duel, the better seed defending, with its
+        winner advancing.
+
+        Every match is played out in memory first; then all the changes of
+        ownership, revenge and nemesis data, and win/loss tallies are written
+        in a single transaction, with all entrants' rows locked throughout.
+
+        :return: a :class:`TournamentResult`, or ``None`` if fewer than two
+                 of ``nicks`` have a waifu to fight over
+        """
+        nicks = {self.db.make_identifier(nick).lower(): nick for nick in nicks}
+        self._flush_buffered(channel, nicks.values())
+
+        channel_slug = self._channel_slug(channel)
+
+        with self.db.session() as session:
+            entrants = self._select_holders(
+                session, channel_slug, nicks, chunk_size)
+            if len(entrants) < 2:
+                return None
+
+            wins = collections.Counter()
+            for start in range(0, len(entrants), chunk_size):
+                wins.update(dict(session.execute(
+                    select(FightRecords.nick_id, FightRecords.wins)
+                    .where(FightRecords.channel == channel_slug)
+                    .where(FightRecords.nick_id.in_(
+                        list(entrants)[start:start + chunk_size]))
+                ).all()))
+
+            seeded = sorted(
+                entrants, key=lambda nick_id: (-wins[nick_id], rng.random()))
+            size = 1 << (len(seeded) - 1).bit_length()
+            # None is a bye; the other side of the pair goes through unopposed
+            alive = [
+                seeded[seed - 1] if seed <= len(seeded) else None
+                for seed in bracket_order(size)
+            ]
+            seed_of = {nick_id: seed for seed, nick_id in enumerate(seeded)}
+
+            matches = []
+            tallies = collections.defaultdict(collections.Counter)
+            spoils_ids = []
+            round_number = 0
+            while len(alive) > 1:
+                round_number += 1
+                advancing = []
+                for first, second in zip(alive[::2], alive[1::2]):
+                    if first is None or second is None:
+                        advancing.append(first if second is None else second)
+                        continue
+
+                    defender_id, challenger_id = sorted(
+                        (first, second), key=seed_of.get)
+                    defender, defender_nick = entrants[defender_id]
+                    challenger, challenger_nick = entrants[challenger_id]
+                    spoils_id = defender.waifu_id
+                    revenge = defender.prev_owner_id == challenger_id
+                    challenger_wins = rng.random() < 0.5
+
+                    if challenger_wins:
+                        challenger.waifu_id = spoils_id
+                        challenger.prev_owner_id = defender_id
+                        challenger.nemesis = None
+                        defender.waifu_id = None
+                        defender.prev_owner_id = None
+                        defender.nemesis = challenger_nick
+                        winner_id, loser_id = challenger_id, defender_id
+                    else:
+                        winner_id, loser_id = defender_id, challenger_id
+
+                    tallies[winner_id].update(
+                        wins=1,
+                        steals=int(challenger_wins),
+                        revenge_wins=int(challenger_wins and revenge),
+                    )
+                    tallies[loser_id]['losses'] += 1
+                    spoils_ids.append(spoils_id)
+                    matches.append((
+                        round_number, challenger_id, defender_id, spoils_id,
+                        challenger_wins, revenge,
+                    ))
+                    advancing.append(winner_id)
+
+                alive = advancing
+
+            champion_id = alive[0]
+            # every entrant's waifu, not just the spoils: a challenger who
+            # lost still has theirs, and their cached row needs its name
+            waifu_ids = list(set(spoils_ids) | {
+                row.waifu_id for row, _ in entrants.values()
+                if row.waifu_id is not None
+            })
+            waifus = {}
+            for start in range(0, len(waifu_ids), chunk_size):
+                for entry in session.execute(
+                    select(CatalogEntries).where(CatalogEntries.id.in_(
+                        waifu_ids[start:start + chunk_size]))
+                ).scalars():
+                    waifus[entry.id] = _format_waifu(entry.name, entry.franchise)
+
+            # read before committing, which expires the rows
+            final_rows = {
+                (nick_id, channel_slug): StatsRow(
+                    waifus.get(row.waifu_id), row.prev_owner_id, row.nemesis)
+                for nick_id, (row, _) in entrants.items()
+            }
+
+            # drop cached copies before committing, so no reader can re-cache
+            # the old values in between
+            for nick_id in entrants:
+                self.row_cache.invalidate((nick_id, channel_slug))
+
+            deltas = [
+                dict(counts, nick_id=nick_id) for nick_id, counts in tallies.items()
+            ]
+            for start in range(0, len(deltas), chunk_size):
+                self._tally_records(
+                    session, channel_slug, deltas[start:start + chunk_size])
+
+            session.commit()
+
+        # the new values are known without asking the DB
+        for key, row in final_rows.items():
+            self.row_cache.put(key, row)
+
+        timestamp = _utcnow()
+        results = []
+        for (round_number, challenger_id, defender_id, spoils_id,
+             challenger_wins, revenge) in matches:
+            self._count(spoils_id, 'fights')
+            if challenger_wins:
+                self._count(spoils_id, 'steals')
+
+            if self._fight_log is not None:
+                if not challenger_wins:
+                    outcome = 'defended'
+                else:
+                    outcome = 'revenge' if revenge else 'stolen'
+                self._fight_log.put({
+                    'timestamp': timestamp,
+                    'channel': channel_slug,
+                    'challenger_id': challenger_id,
+                    'defender_id': defender_id,
+                    'waifu_id': spoils_id,
+                    'outcome': outcome,
+                })
+
+            results.append(TournamentMatch(
+                round_number,
+                entrants[challenger_id][1],
+                entrants[defender_id][1],
+                waifus.get(spoils_id, '?'),
+                challenger_wins,
+                revenge,
+            ))
+
+        return TournamentResult(
+            entrants[champion_id][1],
+            results[-1].waifu,
+            len(entrants),
+            round_number,
+            results,
+        )
+
+    def _tally_records(self, session, channel_slug, deltas):
+        """Add ``deltas`` to :class:`FightRecords` counters within ``session``.
+
+        Each delta is a dict with a ``nick_id`` and the amounts to add to any
+        of :data:`FIGHT_RECORD_STATS`.
+        """
+        rows = [
+            dict(
+                {stat: delta.get(stat, 0) for stat in FIGHT_RECORD_STATS},
+                nick_id=delta['nick_id'],
+                channel=channel_slug,
+            )
+            for delta in deltas
+        ]
+
+        upsert = upsert_statement(
+            self.db.engine.dialect,
+            FightRecords,
+            rows,
+            ['nick_id', 'channel'],
+            increment=FIGHT_RECORD_STATS,
+        )
+        if upsert is not None:
+            session.execute(upsert)
+            return
+
+        records = {
+            record.nick_id: record for record in session.execute(
+                select(FightRecords)
+                .where(FightRecords.channel == channel_slug)
+                .where(FightRecords.nick_id.in_([row['nick_id'] for row in rows]))
+                .with_for_update()
+            ).scalars()
+        }
+        for row in rows:
+            if (record := records.get(row['nick_id'])) is None:
+                session.add(FightRecords(**row))
+                continue
+            for stat in FIGHT_RECORD_STATS:
+                setattr(record, stat, getattr(record, stat) + row[stat])
+
+    def get_fight_record(self, nick, channel):
+        """Get ``nick``'s :class:`FightRecord` in ``channel``, or ``None``."""
         try:
-            nick_id = self.db.get_nick_id(nick)
+            nick_id = self._nick_id(nick)
         except ValueError:
-            # if they're not in the DB, they can't have a nemesis yet
+            # if they're not in the DB, they can't have fought yet
             return None
 
-        channel_slug = self.db.get_channel_slug(channel)
+        channel_slug = self._channel_slug(channel)
 
         with self.db.session() as session:
             result = session.execute(
-                select(FightStats.waifu, FightStats.nemesis)
-                .where(FightStats.nick_id == nick_id)
-                .where(FightStats.channel == channel_slug)
+                select(*(getattr(FightRecords, stat) for stat in FIGHT_RECORD_STATS))
+                .where(FightRecords.nick_id == nick_id)
+                .where(FightRecords.channel == channel_slug)
             ).one_or_none()
 
-            if result is None or result.waifu:
-                return None
-            return result.nemesis
+        if result is None:
+            return None
+        return FightRecord(nick, *result)
+
+    def get_leaderboard(self, channel, stat='wins', limit=5):
+        """Get the top ``limit`` :class:`FightRecord` holders by ``stat``."""
+        if stat not in FIGHT_RECORD_STATS:
+            raise ValueError('Unknown fight stat: {!r}'.format(stat))
+
+        channel_slug = self._channel_slug(channel)
+        column = getattr(FightRecords, stat)
+
+        with self.db.session() as session:
+            top = session.execute(
+                select(
+                    FightRecords.nick_id,
+                    *(getattr(FightRecords, stat) for stat in FIGHT_RECORD_STATS),
+                )
+                .where(FightRecords.channel == channel_slug)
+                .where(column > 0)
+                .order_by(column.desc(), FightRecords.nick_id)
+                .limit(limit)
+            ).all()
+
+            if not top:
+                return []
+
+            # any one of each group's nicks will do for display
+            names = dict(session.execute(
+                select(Nicknames.nick_id, func.min(Nicknames.canonical))
+                .where(Nicknames.nick_id.in_([row[0] for row in top]))
+                .group_by(Nicknames.nick_id)
+            ).all())
+
+        return [
+            FightRecord(names.get(nick_id, '?'), *stats)
+            for nick_id, *stats in top
+        ]
+
+    def _insert_fight_log(self, rows):
+        with self.db.session() as session:
+            session.execute(insert(FightLog), rows)
+            session.commit()
+
+    def get_fight_log(self, channel, nick=None, limit=10):
+        """Get the last ``limit`` duels in ``channel``, newest first.
+
+        If ``nick`` is given, only duels they took part in are included.
+        """
+        if self._fight_log is not None:
+            # make sure the most recent fights are included
+            self._fight_log.flush()
+
+        channel_slug = self._channel_slug(channel)
+        query = select(
+            FightLog.timestamp,
+            FightLog.challenger_id,
+            FightLog.defender_id,
+            CatalogEntries.name,
+            CatalogEntries.franchise,
+            FightLog.outcome,
+        ).outerjoin(CatalogEntries, FightLog.waifu_id == CatalogEntries.id)
+
+        if nick is None:
+            queries = [query.where(FightLog.channel == channel_slug)]
+        else:
+            try:
+                nick_id = self._nick_id(nick)
+            except ValueError:
+                return []
+            # two indexed lookups merged here, rather than one OR the DB
+            # can't use an index for
+            queries = [
+                query
+                .where(FightLog.challenger_id == nick_id)
+                .where(FightLog.channel == channel_slug),
+                query
+                .where(FightLog.defender_id == nick_id)
+                .where(FightLog.channel == channel_slug),
+            ]
+
+        with self.db.session() as session:
+            fights = heapq.nlargest(limit, itertools.chain.from_iterable(
+                session.execute(
+                    query.order_by(FightLog.timestamp.desc()).limit(limit))
+                for query in queries
+            ), key=lambda fight: fight.timestamp)
+            ids = {
+                nick_id for fight in fights for nick_id in fight[1:3]
+            }
+            names = dict(session.execute(
+                select(Nicknames.nick_id, func.min(Nicknames.canonical))
+                .where(Nicknames.nick_id.in_(ids))
+                .group_by(Nicknames.nick_id)
+            ).all()) if ids else {}
+
+        return [
+            FightLogEntry(
+                timestamp,
+                names.get(challenger_id, '?'),
+                names.get(defender_id, '?'),
+                None if name is None else _format_waifu(name, franchise),
+                outcome,
+            )
+            for (
+                timestamp, challenger_id, defender_id, name, franchise, outcome,
+            ) in fights
+        ]
+
+    def prune_fight_log(self, max_age, chunk_size=500):
+        """Delete duels older than ``max_age`` (a :class:`~datetime.timedelta`).
+
+        Rows are deleted ``chunk_size`` at a time, each chunk in its own short
+        transaction, so the table is never locked for long. Returns the number
+        of rows deleted.
+        """
+        cutoff = _utcnow() - max_age
+        deleted = 0
+
+        while True:
+            with self.db.session() as session:
+                ids = session.execute(
+                    select(FightLog.id)
+                    .where(FightLog.timestamp < cutoff)
+                    .order_by(FightLog.timestamp)
+                    .limit(chunk_size)
+                ).scalars().all()
+
+                if not ids:
+                    break
+
+                session.execute(
+                    delete(FightLog)
+                    .where(FightLog.id.in_(ids))
+                    .execution_options(synchronize_session=False)
+                )
+                session.commit()
+
+            deleted += len(ids)
+            if len(ids) < chunk_size:
+                break
+
+        return deleted
+
+    def _count(self, waifu_id, stat):
+        if self._popularity is not None:
+            self._popularity.add(waifu_id, stat)
+
+    def count_rolls(self, entries):
+        """Count that each ``(name, franchise)`` in ``entries`` came up.
+
+        Only touches memory; the counts reach the DB with the next flush.
+        """
+        for entry in entries:
+            self._count(catalog_id(*entry), 'rolls')
+
+    def _write_popularity(self, items, chunk_size=150):
+        rows = [
+            dict(
+                {stat: counts.get(stat, 0) for stat in POPULARITY_STATS},
+                waifu_id=waifu_id,
+            )
+            for waifu_id, counts in items
+        ]
+
+        with self.db.session() as session:
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                upsert = upsert_statement(
+                    self.db.engine.dialect,
+                    WaifuPopularity,
+                    chunk,
+                    ['waifu_id'],
+                    increment=POPULARITY_STATS,
+                )
+                if upsert is not None:
+                    session.execute(upsert)
+                    continue
+
+                counters = {
+                    counter.waifu_id: counter for counter in session.execute(
+                        select(WaifuPopularity)
+                        .where(WaifuPopularity.waifu_id.in_(
+                            [row['waifu_id'] for row in chunk]))
+                        .with_for_update()
+                    ).scalars()
+                }
+                for row in chunk:
+                    if (counter := counters.get(row['waifu_id'])) is None:
+                        session.add(WaifuPopularity(**row))
+                        continue
+                    for stat in POPULARITY_STATS:
+                        setattr(counter, stat, getattr(counter, stat) + row[stat])
+
+            session.commit()
+
+        # already on the background thread, so this is the cheap place for it
+        self._refresh_popular()
+
+    def _refresh_popular(self):
+        popular = {}
+        with self.db.session() as session:
+            for stat in POPULARITY_STATS:
+                column = getattr(WaifuPopularity, stat)
+                popular[stat] = [
+                    (_format_waifu(name, franchise), count)
+                    for name, franchise, count in session.execute(
+                        select(CatalogEntries.name, CatalogEntries.franchise, column)
+                        .join(CatalogEntries, WaifuPopularity.waifu_id == CatalogEntries.id)
+                        .where(column > 0)
+                        .order_by(column.desc(), WaifuPopularity.waifu_id)
+                        .limit(self.popular_size)
+                    )
+                ]
+        self._popular = popular
+
+    def get_popular(self, stat='rolls'):
+        """Get the most popular ``(waifu, count)`` pairs by ``stat``.
+
+        Results are only as fresh as the last flush of popularity counts.
+        """
+        if stat not in POPULARITY_STATS:
+            raise ValueError('Unknown popularity stat: {!r}'.format(stat))
+        if self._popular is None:
+            self._refresh_popular()
+        return self._popular[stat]
 
     def steal_waifu(self, thief, channel, victim):
         """Record that ``thief`` stole ``victim``'s waifu in ``channel``."""
-        if (spoils := self.get_waifu(victim, channel)) is None:
-            raise NoWaifuError(victim, channel)
-
-        # Would ideally like these two updates to be a single atomic operation,
-        # but either sqlalchemy doesn't make it easy, or I'm too stupid to
-        # figure out how to structure it.
-        self.set_waifu(thief, channel, spoils, self.db.get_nick_id(victim))
-        self.clear_waifu(victim, channel, thief=thief)
+        self.duel(thief, channel, victim, challenger_wins=True)
+
+    def get_shuffle_bags(self):
+        """Get saved ``(channel, size, seed, position)`` shuffle bag states."""
+        with self.db.session() as session:
+            return [
+                tuple(row) for row in session.execute(
+                    select(
+                        ShuffleBags.channel,
+                        ShuffleBags.size,
+                        ShuffleBags.seed,
+                        ShuffleBags.position,
+                    )
+                )
+            ]
+
+    def save_shuffle_bags(self, states, chunk_size=200):
+        """Save ``(channel, size, seed, position)`` shuffle bag states."""
+        if not (states := list(states)):
+            return
+
+        rows = [
+            {
+                'channel': channel,
+                'size': size,
+                'seed': seed,
+                'position': position,
+            }
+            for channel, size, seed, position in states
+        ]
+
+        with self.db.session() as session:
+            # kept under SQLite's limit on bound parameters, however many
+            # channels there are
+            upserts = [
+                upsert_statement(
+                    self.db.engine.dialect,
+                    ShuffleBags,
+                    rows[start:start + chunk_size],
+                    ['channel'],
+                )
+                for start in range(0, len(rows), chunk_size)
+            ]
+            if None not in upserts:
+                for upsert in upserts:
+                    session.execute(upsert)
+                session.commit()
+                return
+
+            for channel, size, seed, position in states:
+                result = session.execute(
+                    select(ShuffleBags)
+                    .where(ShuffleBags.channel == channel)
+                ).scalar_one_or_none()
+
+                if result:
+                    result.size = size
+                    result.seed = seed
+                    result.position = position
+                else:
+                    session.add(ShuffleBags(
+                        channel=channel,
+                        size=size,
+                        seed=seed,
+                        position=position,
+                    ))
+
+            session.commit()
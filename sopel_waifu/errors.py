@@ -4,6 +4,8 @@ Part of sopel-waifu. Copyright 2024 dgw, technobabbl.es
 """
 from __future__ import annotations
 
+import os
+
 
 class WaifuError(Exception):
     """Base class for sopel-waifu plugin errors."""
@@ -17,3 +19,20 @@ class NoWaifuError(WaifuError):
 
     def __str__(self):
         return f"{self.nick} doesn't have a waifu in {self.channel} yet."
+
+
+class ListLoadError(WaifuError):
+    """One or more waifu list files couldn't be loaded."""
+    def __init__(self, failures):
+        self.failures = failures
+        """List of ``(filename, exception)`` pairs."""
+
+    def __str__(self):
+        return "Couldn't load {} waifu list file{}: {}".format(
+            len(self.failures),
+            '' if len(self.failures) == 1 else 's',
+            '; '.join(
+                '{}: {}'.format(os.path.basename(filename), exc)
+                for filename, exc in self.failures
+            ),
+        )
@@ -0,0 +1,180 @@
+"""sopel-waifu locks submodule
+
+Part of sopel-waifu. Copyright 2024 dgw, technobabbl.es
+"""
+from __future__ import annotations
+
+import contextlib
+import threading
+import time
+
+from sopel import tools
+
+
+LOGGER = tools.get_logger('waifu')
+
+
+class StripedLock:
+    """Fixed pool of locks shared out among any number of keys.
+
+    Each key (e.g. a ``(channel, nick)`` pair) always maps to the same one of
+    ``stripes`` locks, so handlers touching the same keys are serialized while
+    everything else (other channels, say) carries on in parallel, without
+    keeping a lock around for every key ever seen. Unrelated keys sharing a
+    stripe just wait on each other occasionally.
+
+    :meth:`hold` takes every stripe it needs in ascending order, which is what
+    keeps two callers locking overlapping keys from deadlocking.
+
+    Tuple keys are grouped by their first item (e.g. the channel): all keys
+    in a group share a block of ``group_stripes`` stripes. Locking every key
+    in one group at once therefore still leaves the other stripes, and most
+    other groups, free.
+
+    Contention is tracked: how many acquisitions had to wait, and for how
+    long in total and at most.
+    """
+
+    def __init__(self, stripes=64, group_stripes=None):
+        if stripes < 1:
+            raise ValueError('Need at least one lock stripe.')
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._group_stripes = min(stripes, group_stripes or max(1, stripes // 4))
+        self._stats_lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def __len__(self):
+        return len(self._locks)
+
+    def stripes_for(self, keys):
+        """Get the sorted, distinct stripe numbers covering ``keys``."""
+        return sorted({self._stripe(key) for key in keys})
+
+    def _stripe(self, key):
+        if not isinstance(key, tuple) or len(key) < 2:
+            return hash(key) % len(self._locks)
+        group, rest = key[0], key[1:]
+        return (
+            hash(group) + hash(rest) % self._group_stripes
+        ) % len(self._locks)
+
+    def _acquire(self, stripe):
+        lock = self._locks[stripe]
+        if lock.acquire(blocking=False):
+            return 0.0
+
+        start = time.perf_counter()
+        lock.acquire()
+        return time.perf_counter() - start
+
+    @contextlib.contextmanager
+    def hold(self, *keys):
+        """Hold the locks for all of ``keys`` for the duration of a block."""
+        stripes = self.stripes_for(keys)
+        held = []
+        waited = []
+        try:
+            for stripe in stripes:
+                waited.append(self._acquire(stripe))
+                held.append(stripe)
+        except BaseException:
+            for stripe in reversed(held):
+                self._locks[stripe].release()
+            raise
+
+        self._record(waited, keys)
+        try:
+            yield
+        finally:
+            for stripe in reversed(held):
+                self._locks[stripe].release()
+
+    def _record(self, waited, keys):
+        contended = [wait for wait in waited if wait]
+        with self._stats_lock:
+            self.acquisitions += len(waited)
+            self.contended += len(contended)
+            self.wait_total += sum(contended)
+            self.wait_max = max(self.wait_max, *contended, 0.0)
+
+        if contended:
+            LOGGER.debug("Waited %.1f ms for lock(s) on %r",
+                         sum(contended) * 1000, keys)
+
+    def stats(self):
+        """Get a dict of contention counters."""
+        with self._stats_lock:
+            return {
+                'stripes': len(self._locks),
+                'acquisitions': self.acquisitions,
+                'contended': self.contended,
+                'wait_total': self.wait_total,
+                'wait_max': self.wait_max,
+            }
+
+
+class BackgroundOnce:
+    """Run ``function`` once, on a background thread, when first needed.
+
+    :meth:`start` begins the run unless it's already running or has
+    succeeded; :meth:`wait` also waits (up to a timeout) for it to finish.
+    Any number of threads can call either at once, and ``function`` still
+    runs only once. If it raises, the exception is kept in :attr:`error` and
+    the next :meth:`start` tries again.
+    """
+
+    def __init__(self, function, name=None):
+        self._function = function
+        self._name = name
+        self._lock = threading.Lock()
+        self._thread = None
+        self._done = threading.Event()
+        self.error = None
+        """The exception from the last run, if it failed."""
+
+    @property
+    def succeeded(self):
+        """Whether ``function`` has finished without raising."""
+        return self._done.is_set() and self.error is None
+
+    @property
+    def running(self):
+        """Whether ``function`` is running right now."""
+        return self._thread is not None and not self._done.is_set()
+
+    def start(self):
+        """Start running ``function``, if it isn't running and hasn't succeeded."""
+        with self._lock:
+            if self.succeeded or self.running:
+                return
+            self.error = None
+            self._done.clear()
+            self._thread = threading.Thread(
+                target=self._run, name=self._name, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        try:
+            self._function()
+        except Exception as exc:
+            LOGGER.exception("Background task %s failed", self._name)
+            self.error = exc
+        finally:
+            self._done.set()
+
+    def wait(self, timeout=None):
+        """Start if needed, then wait up to ``timeout`` seconds to finish.
+
+        Returns whether ``function`` has now succeeded.
+        """
+        self.start()
+        self._done.wait(timeout)
+        return self.succeeded
+
+    def join(self):
+        """Wait for a run that's in progress, without starting one."""
+        if (thread := self._thread) is not None:
+            thread.join()
@@ -0,0 +1,235 @@
+"""sopel-waifu metrics submodule
+
+Part of sopel-waifu. Copyright 2024 dgw, technobabbl.es
+"""
+from __future__ import annotations
+
+import bisect
+import contextlib
+import functools
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+
+from sopel import tools
+
+
+LOGGER = tools.get_logger('waifu')
+
+# histogram bucket upper bounds, in seconds
+BUCKETS = (
+    0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    """Latency histogram with fixed, Prometheus-style buckets.
+
+    Percentiles are estimated by interpolating within the bucket they fall
+    in, which is plenty precise for spotting which call is slow, and costs
+    the same tiny, fixed amount of memory no matter how many calls happen.
+    """
+    __slots__ = ('counts', 'count', 'sum', 'max', 'queries')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.queries = 0
+
+    def observe(self, seconds, queries=0):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.queries += queries
+
+    def percentile(self, q):
+        """Estimate the ``q``-th quantile (0 < q <= 1), in seconds."""
+        if not self.count:
+            return 0.0
+
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = BUCKETS[i - 1] if i else 0.0
+                upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+                return min(
+                    self.max, lower + (upper - lower) * (rank - seen) / count)
+            seen += count
+        return self.max
+
+
+class Metrics:
+    """Call counts, latency histograms, and SQL statement counts.
+
+    Calls are timed with :meth:`timer` (or :meth:`wrap`). While a call is
+    running, every SQL statement executed *by the same thread* on an engine
+    passed to :meth:`attach` is counted against it (and against any call it
+    is nested inside), so statements sent by the rest of the bot aren't.
+
+    Calls taking at least ``slow_threshold`` seconds are logged.
+    """
+
+    def __init__(self, slow_threshold=None):
+        self.slow_threshold = slow_threshold or None
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._engines = []
+
+    def attach(self, engine):
+        """Start counting SQL statements executed through ``engine``."""
+        event.listen(engine, 'before_cursor_execute', self._on_statement)
+        self._engines.append(engine)
+
+    def detach(self):
+        """Stop counting SQL statements on every attached engine."""
+        for engine in self._engines:
+            event.remove(engine, 'before_cursor_execute', self._on_statement)
+        self._engines = []
+
+    def _frames(self):
+        try:
+            return self._local.frames
+        except AttributeError:
+            frames = self._local.frames = []
+            return frames
+
+    def _on_statement(self, *args):
+        for frame in self._frames():
+            frame[0] += 1
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Time the enclosed block as one call to ``name``."""
+        frames = self._frames()
+        frame = [0]
+        frames.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            frames.pop()
+            self.observe(name, elapsed, frame[0])
+
+    def observe(self, name, seconds, queries=0):
+        """Record one call to ``name`` that took ``seconds``."""
+        with self._lock:
+            if (histogram := self._histograms.get(name)) is None:
+                histogram = self._histograms[name] = Histogram()
+            histogram.observe(seconds, queries)
+
+        if self.slow_threshold is not None and seconds >= self.slow_threshold:
+            LOGGER.warning("Slow call: %s took %.1f ms (%d SQL statement%s)",
+                           name, seconds * 1000, queries,
+                           '' if queries == 1 else 's')
+
+    def wrap(self, function, name):
+        """Get a version of ``function`` that times each call as ``name``."""
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with self.timer(name):
+                return function(*args, **kwargs)
+        return wrapper
+
+    def instrument(self, obj, names, prefix=''):
+        """Replace each of ``obj``'s methods in ``names`` with a timed one."""
+        for name in names:
+            setattr(obj, name, self.wrap(getattr(obj, name), prefix + name))
+
+    def snapshot(self):
+        """Summarize every call seen so far, by name.
+
+        Times are in milliseconds.
+        """
+        with self._lock:
+            return {
+                name: {
+                    'count': histogram.count,
+                    'p50_ms': histogram.percentile(0.50) * 1000,
+                    'p95_ms': histogram.percentile(0.95) * 1000,
+                    'p99_ms': histogram.percentile(0.99) * 1000,
+                    'max_ms': histogram.max * 1000,
+                    'total_ms': histogram.sum * 1000,
+                    'queries_per_call': histogram.queries / histogram.count,
+                }
+                for name, histogram in self._histograms.items()
+            }
+
+    def prometheus_text(self, extra=()):
+        """Render everything in the Prometheus text exposition format.
+
+        ``extra`` may add more samples, as ``(metric, type, help, labels,
+        value)`` tuples; ``labels`` is a dict (or ``None``).
+        """
+        lines = [
+            '# HELP waifu_call_duration_seconds Time spent in sopel-waifu '
+            'handlers and database methods.',
+            '# TYPE waifu_call_duration_seconds histogram',
+        ]
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            for name, histogram in histograms:
+                cumulative = 0
+                for bound, count in zip(BUCKETS + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(
+                        'waifu_call_duration_seconds_bucket{{call="{}",le="{}"}} {}'
+                        .format(name, bound, cumulative))
+                lines.append('waifu_call_duration_seconds_sum{{call="{}"}} {}'
+                             .format(name, histogram.sum))
+                lines.append('waifu_call_duration_seconds_count{{call="{}"}} {}'
+                             .format(name, histogram.count))
+
+            lines.append(
+                '# HELP waifu_sql_statements_total SQL statements executed '
+                'during sopel-waifu calls.')
+            lines.append('# TYPE waifu_sql_statements_total counter')
+            for name, histogram in histograms:
+                lines.append('waifu_sql_statements_total{{call="{}"}} {}'
+                             .format(name, histogram.queries))
+
+        # each metric's samples have to be listed together
+        families = {}
+        for metric, kind, help_text, labels, value in extra:
+            families.setdefault(metric, (kind, help_text, []))[2].append(
+                (labels, value))
+
+        for metric, (kind, help_text, samples) in families.items():
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} {}'.format(metric, kind))
+            for labels, value in samples:
+                label_text = ','.join(
+                    '{}="{}"'.format(*label) for label in (labels or {}).items())
+                lines.append('{}{} {}'.format(
+                    metric, '{' + label_text + '}' if label_text else '', value))
+
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, filename, extra=()):
+        """Atomically (re)write ``filename`` with :meth:`prometheus_text`.
+
+        Suitable for node_exporter's textfile collector, which could otherwise
+        read a half-written file.
+        """
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp_name = tempfile.mkstemp(
+            prefix='.waifu-metrics.', suffix='.tmp', dir=directory)
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                file.write(self.prometheus_text(extra))
+            os.replace(tmp_name, filename)
+        except BaseException:
+            os.unlink(tmp_name)
+            raise
@@ -0,0 +1,280 @@
+"""sopel-waifu search submodule
+
+Part of sopel-waifu. Copyright 2024 dgw, technobabbl.es
+"""
+from __future__ import annotations
+
+import array
+import bisect
+import collections
+import math
+import re
+import threading
+
+
+NGRAM = 3
+FUZZY_CHARS_PER_EDIT = 4
+"""Query word length allowed one typo (more for longer words) by fuzzy search."""
+
+_WORD = re.compile(r'\w+')
+
+
+def _normalize(text):
+    return ' '.join(text.casefold().split())
+
+
+def _ngrams(text):
+    if len(text) < NGRAM:
+        return {text} if text else set()
+    return {text[i:i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+def _padded_ngrams(text):
+    # so the first and last letters of a word still get a trigram each
+    return _ngrams(' {} '.format(text))
+
+
+def _edit_distance(a, b, limit):
+    """Edits (including swapping two neighbors) to turn ``a`` into ``b``.
+
+    Anything over ``limit`` is returned as ``limit + 1``.
+    """
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    before, previous = None, list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            cost = min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (char != other),
+            )
+            if i > 1 and j > 1 and char == b[j - 2] and a[i - 2] == other:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return min(previous[-1], limit + 1)
+
+
+class _TextIndex:
+    """Substring/prefix/fuzzy index over a table of strings.
+
+    Strings are casefolded and indexed by their trigrams; each trigram maps
+    to a compact array of the string IDs containing it. Substring queries
+    intersect the posting lists of the query's trigrams (rarest first) and
+    only verify the survivors. Queries too short to have a trigram use a
+    sorted word list instead. Each string is padded with a space at either
+    end before indexing, so every word has trigrams for its first and last
+    letters too.
+    """
+
+    def __init__(self, texts):
+        self.texts = [_normalize(text) for text in texts]
+
+        postings = collections.defaultdict(set)
+        words = set()
+        for text_id, text in enumerate(self.texts):
+            for gram in _padded_ngrams(text):
+                postings[gram].add(text_id)
+            for word in text.split():
+                words.add((word, text_id))
+            words.add((text, text_id))
+
+        self._postings = {
+            gram: array.array('I', sorted(ids))
+            for gram, ids in postings.items()
+        }
+        self._words = sorted(words)
+
+    def exact(self, query):
+        """IDs of strings equal to ``query``, ignoring case."""
+        query = _normalize(query)
+        return [
+            text_id for text_id in self.prefix(query)
+            if self.texts[text_id] == query
+        ]
+
+    def prefix(self, query):
+        """IDs of strings where any word (or the whole) starts with ``query``."""
+        query = _normalize(query)
+        if not query:
+            return []
+
+        result = set()
+        start = bisect.bisect_left(self._words, (query,))
+        for word, text_id in self._words[start:]:
+            if not word.startswith(query):
+                break
+            result.add(text_id)
+        return sorted(result)
+
+    def substring(self, query):
+        """IDs of strings containing ``query``, ignoring case."""
+        query = _normalize(query)
+        if len(query) < NGRAM:
+            return self.prefix(query)
+
+        lists = []
+        for gram in _ngrams(query):
+            if (ids := self._postings.get(gram)) is None:
+                return []
+            lists.append(ids)
+        lists.sort(key=len)
+
+        candidates = set(lists[0])
+        for ids in lists[1:]:
+            candidates.intersection_update(ids)
+            if not candidates:
+                return []
+
+        return sorted(
+            text_id for text_id in candidates
+            if query in self.texts[text_id]
+        )
+
+    def fuzzy(self, query, limit=10):
+        """IDs of strings with words close to those in ``query``.
+
+        Each query word is matched on its own, against any word of a string,
+        allowing one typo (a wrong, missing, extra, or swapped letter) per
+        :data:`FUZZY_CHARS_PER_EDIT` letters. That way word order doesn't
+        matter, and short words aren't held to the same share of trigrams as
+        long ones. At least half of the query words must match.
+
+        Strings are ranked by how many query words match, then by how many
+        typos that took, then by how few other words they have.
+        """
+        words = _WORD.findall(_normalize(query))
+        if not words:
+            return []
+
+        allowed = [max(1, len(word) // FUZZY_CHARS_PER_EDIT) for word in words]
+        candidates = set()
+        for word, edits in zip(words, allowed):
+            grams = _padded_ngrams(word)
+            overlap = collections.Counter()
+            for gram in grams:
+                overlap.update(self._postings.get(gram, ()))
+            # each typo can break at most NGRAM + 1 of the word's trigrams
+            needed = max(1, len(grams) - edits * (NGRAM + 1))
+            candidates.update(
+                text_id for text_id, shared in overlap.items()
+                if shared >= needed
+            )
+
+        needed_words = math.ceil(len(words) / 2)
+        # the same words turn up in many strings (e.g. "no" in titles)
+        distances = {}
+        scored = []
+        for text_id in candidates:
+            text_words = _WORD.findall(self.texts[text_id])
+            matched = typos = 0
+            for word, edits in zip(words, allowed):
+                distance = edits + 1
+                for other in text_words:
+                    if (key := (word, other)) not in distances:
+                        distances[key] = _edit_distance(word, other, edits)
+                    distance = min(distance, distances[key])
+                if distance <= edits:
+                    matched += 1
+                    typos += distance
+            if matched >= needed_words:
+                scored.append(
+                    (-matched, typos, len(text_words) - matched, text_id))
+
+        return [text_id for *_, text_id in sorted(scored)[:limit]]
+
+
+class SearchIndex:
+    """Name and franchise lookups over a :class:`~.catalog.WaifuCatalog`.
+
+    Built once when the catalog is loaded (or, if ``lazy``, by whichever
+    query comes first); each query touches only the posting lists it needs,
+    rather than scanning the whole catalog.
+    """
+
+    def __init__(self, catalog, lazy=False):
+        self.catalog = catalog
+        self._built = False
+        self._build_lock = threading.Lock()
+        if not lazy:
+            self._build()
+
+    @property
+    def built(self):
+        """Whether the index has been built yet."""
+        return self._built
+
+    def _ensure_built(self):
+        if not self._built:
+            with self._build_lock:
+                if not self._built:
+                    self._build()
+
+    def _build(self):
+        catalog = self.catalog
+        self._names = _TextIndex(catalog.names)
+        self._franchises = _TextIndex(catalog.franchises)
+
+        by_name = collections.defaultdict(list)
+        by_franchise = collections.defaultdict(list)
+        for index, (name_id, franchise_id) in enumerate(catalog.entry_ids()):
+            by_name[name_id].append(index)
+            by_franchise[franchise_id].append(index)
+
+        self._by_name = {
+            name_id: array.array('I', indices)
+            for name_id, indices in by_name.items()
+        }
+        self._by_franchise = {
+            franchise_id: array.array('I', indices)
+            for franchise_id, indices in by_franchise.items()
+        }
+        self._franchise_ids = {
+            franchise: franchise_id
+            for franchise_id, franchise in enumerate(catalog.franchises)
+        }
+        self._built = True
+
+    def _entries_named(self, name_ids, ranked=False):
+        result = []
+        for name_id in name_ids:
+            result.extend(self._by_name.get(name_id, ()))
+        # ranked results stay in the order their names were ranked in
+        return result if ranked else sorted(result)
+
+    def find_characters(self, query):
+        """Find catalog indices of characters matching ``query``.
+
+        Returns ``(indices, fuzzy)``, where ``fuzzy`` is true if no name
+        contained ``query`` and the results are only close matches.
+        """
+        self._ensure_built()
+        if indices := self._entries_named(self._names.substring(query)):
+            return indices, False
+        return self._entries_named(self._names.fuzzy(query), ranked=True), True
+
+    def find_franchises(self, query):
+        """Find franchise titles matching ``query``.
+
+        Returns ``(titles, fuzzy)``, like :meth:`find_characters`. An exact
+        (case-insensitive) title match is returned alone.
+        """
+        self._ensure_built()
+        franchises = self.catalog.franchises
+        if exact := self._franchises.exact(query):
+            return [franchises[i] for i in exact], False
+        if ids := self._franchises.substring(query):
+            return [franchises[i] for i in ids], False
+        return [franchises[i] for i in self._franchises.fuzzy(query)], True
+
+    def franchise_entries(self, franchise):
+        """Catalog indices of every character from ``franchise``."""
+        self._ensure_built()
+        if (franchise_id := self._franchise_ids.get(franchise)) is None:
+            return []
+        return list(self._by_franchise.get(franchise_id, ()))
@@ -0,0 +1,292 @@
+"""sopel-waifu selection submodule
+
+Part of sopel-waifu. Copyright 2024 dgw, technobabbl.es
+"""
+from __future__ import annotations
+
+import array
+import collections
+import datetime
+import hashlib
+import random
+import threading
+
+
+class AliasTable:
+    """Weighted random index sampler using Vose's alias method.
+
+    Building the table is O(n); each pick afterward is O(1), no matter how
+    many entries there are or how skewed their weights are.
+    """
+    __slots__ = ('prob', 'alias', 'positive')
+
+    def __init__(self, weights):
+        count = len(weights)
+        total = 0.0
+        positive = 0
+        for weight in weights:
+            if not 0 <= weight < float('inf'):
+                raise ValueError('Invalid weight: {!r}'.format(weight))
+            total += weight
+            positive += weight > 0
+
+        if count and not total:
+            raise ValueError('At least one weight must be positive.')
+
+        self.prob = array.array('d', bytes(8 * count))
+        self.alias = array.array('I', range(count))
+        self.positive = positive
+
+        scaled = [weight * count / total for weight in weights] if count else []
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] = scaled[more] + scaled[less] - 1
+            (small if scaled[more] < 1 else large).append(more)
+
+        # whatever's left is (within rounding error) exactly full
+        for i in large + small:
+            self.prob[i] = 1.0
+
+    def __len__(self):
+        return len(self.prob)
+
+    def pick(self, rng=random):
+        """Pick one index, weighted."""
+        if not self.prob:
+            raise IndexError('Cannot choose from an empty sequence')
+
+        i = rng.randrange(len(self.prob))
+        return i if rng.random() < self.prob[i] else self.alias[i]
+
+    def sample(self, k, rng=random):
+        """Pick ``k`` distinct indices, weighted, without replacement.
+
+        Repeats are rejected and redrawn, which stays O(k) in practice;
+        pathologically skewed tables fall back to an exact O(n) draw.
+        """
+        if not 0 <= k <= self.positive:
+            raise ValueError('Sample larger than population or is negative')
+
+        result = []
+        seen = set()
+        for _ in range(16 * k + 16):
+            if len(result) == k:
+                return result
+            if (i := self.pick(rng)) not in seen:
+                seen.add(i)
+                result.append(i)
+
+        return result + self._exact_sample(k - len(result), seen, rng)
+
+    def _exact_sample(self, k, exclude, rng):
+        # reconstruct each entry's weight (relative to the mean) from the
+        # table, then draw sequentially from what's left
+        weights = list(self.prob)
+        for i, alias in enumerate(self.alias):
+            weights[alias] += 1 - self.prob[i]
+
+        result = []
+        for _ in range(k):
+            for i in exclude:
+                weights[i] = 0.0
+            i = rng.choices(range(len(weights)), weights)[0]
+            exclude = (i,)
+            result.append(i)
+
+        return result
+
+
+class ShuffleBag:
+    """Lazily shuffled permutation of ``range(size)``.
+
+    Draws walk a Fisher-Yates shuffle one step at a time, keeping only the
+    positions that have actually been swapped, so memory use grows with the
+    number of draws made rather than with ``size``. The whole state can be
+    recreated from ``(size, seed, position)`` by replaying the draws, which is
+    what gets persisted.
+
+    Once every index has been drawn, the bag refills itself with a fresh
+    shuffle.
+    """
+    __slots__ = ('size', 'seed', 'position', '_rng', '_swaps')
+
+    def __init__(self, size, seed=None, position=0):
+        self.size = size
+        self._reset(seed)
+        for _ in range(min(position, size)):
+            self._draw()
+
+    def _reset(self, seed=None):
+        self.seed = random.getrandbits(63) if seed is None else seed
+        self.position = 0
+        self._rng = random.Random(self.seed)
+        self._swaps = {}
+
+    def _draw(self):
+        i = self.position
+        j = self._rng.randrange(i, self.size)
+        swaps = self._swaps
+        value = swaps.get(j, j)
+        # position i is never looked at again, so it doesn't need an entry
+        if j != i:
+            swaps[j] = swaps.pop(i, i)
+        else:
+            swaps.pop(i, None)
+        self.position += 1
+        return value
+
+    def __len__(self):
+        """Number of indices left before the bag refills."""
+        return self.size - self.position
+
+    def draw(self):
+        """Take the next index from the bag."""
+        if not self.size:
+            raise IndexError('Cannot choose from an empty sequence')
+        if self.position >= self.size:
+            self._reset()
+        return self._draw()
+
+    def draw_many(self, k):
+        """Take ``k`` distinct indices from the bag."""
+        if not 0 <= k <= self.size:
+            raise ValueError('Sample larger than population or is negative')
+
+        result = []
+        while len(result) < k:
+            # only a refill partway through can produce a repeat
+            if (i := self.draw()) not in result:
+                result.append(i)
+        return result
+
+
+class RecentWindow:
+    """Remembers the last ``size`` picks, to avoid repeating them."""
+    __slots__ = ('_recent', '_members')
+
+    def __init__(self, size):
+        self._recent = collections.deque(maxlen=size)
+        self._members = collections.Counter()
+
+    def __contains__(self, index):
+        return index in self._members
+
+    def add(self, index):
+        if not self._recent.maxlen:
+            return
+        if len(self._recent) == self._recent.maxlen:
+            oldest = self._recent[0]
+            self._members[oldest] -= 1
+            if not self._members[oldest]:
+                del self._members[oldest]
+        self._recent.append(index)
+        self._members[index] += 1
+
+
+class ChannelSelector:
+    """Per-channel waifu selection state.
+
+    In ``random`` mode, picks are independent, except that if ``window`` is
+    set, anything picked in the same channel within the last ``window`` picks
+    is redrawn (best-effort; weights are still honored).
+
+    In ``shuffle`` mode, each channel draws from its own :class:`ShuffleBag`,
+    so nothing repeats until the whole list has come up once. Weights are
+    ignored in this mode.
+    """
+
+    # how many times to redraw a recent pick before giving up and allowing it
+    WINDOW_RETRIES = 16
+
+    def __init__(self, mode='random', window=0):
+        if mode not in ('random', 'shuffle'):
+            raise ValueError('Unknown selection mode: {!r}'.format(mode))
+        self.mode = mode
+        self.window = max(0, window)
+        self._lock = threading.Lock()
+        self._bags = {}
+        self._windows = {}
+
+    def load_bags(self, states):
+        """Restore shuffle bags from ``(channel, size, seed, position)`` rows."""
+        with self._lock:
+            for channel, size, seed, position in states:
+                self._bags[channel] = ShuffleBag(size, seed, position)
+
+    def bag_states(self):
+        """Get ``(channel, size, seed, position)`` for every shuffle bag."""
+        with self._lock:
+            return [
+                (channel, bag.size, bag.seed, bag.position)
+                for channel, bag in self._bags.items()
+            ]
+
+    def _bag(self, channel, size):
+        bag = self._bags.get(channel)
+        if bag is None or bag.size != size:
+            # new channel, or the list was reloaded with a different length
+            bag = self._bags[channel] = ShuffleBag(size)
+        return bag
+
+    def _window(self, channel):
+        if (window := self._windows.get(channel)) is None:
+            window = self._windows[channel] = RecentWindow(self.window)
+        return window
+
+    def choice_index(self, catalog, channel, rng=random):
+        """Pick the index of one entry from ``catalog`` for ``channel``."""
+        if self.mode == 'shuffle':
+            with self._lock:
+                return self._bag(channel, len(catalog)).draw()
+
+        if not self.window:
+            return catalog.choice_index(rng)
+
+        if not catalog:
+            raise IndexError('Cannot choose from an empty sequence')
+        return self.sample_indices(catalog, channel, 1, rng)[0]
+
+    def sample_indices(self, catalog, channel, k, rng=random):
+        """Pick the indices of ``k`` distinct entries for ``channel``."""
+        if self.mode == 'shuffle':
+            with self._lock:
+                return self._bag(channel, len(catalog)).draw_many(k)
+
+        if not self.window:
+            return catalog.sample_indices(k, rng)
+
+        with self._lock:
+            window = self._window(channel)
+            for _ in range(self.WINDOW_RETRIES):
+                result = catalog.sample_indices(k, rng)
+                if not any(i in window for i in result):
+                    break
+            for i in result:
+                window.add(i)
+            return result
+
+
+def daily_index(catalog, salt, *keys, day=None):
+    """Pick the index of ``catalog``'s entry of the day for ``keys``.
+
+    The pick is a pure function of ``salt``, ``keys`` (e.g. the channel and
+    nick), ``day`` (default: today, in UTC), and the catalog's order and
+    weights, so asking again the same day gives the same answer without
+    storing anything, even after reloading an unchanged list. Keeping
+    ``salt`` secret keeps anyone from working out future days' picks.
+    """
+    if day is None:
+        day = datetime.datetime.now(datetime.timezone.utc).date()
+
+    digest = hashlib.sha256('\0'.join(
+        [salt, day.isoformat(), *keys]).encode('utf-8', 'surrogatepass'))
+    # a throwaway generator, seeded from the hash, lets weighted catalogs
+    # pick the same way they always do
+    return catalog.choice_index(random.Random(digest.digest()))
+
@@ -0,0 +1,35 @@
+"""Tests for the sopel-waifu catalog submodule."""
+from __future__ import annotations
+
+import pytest
+
+from sopel_waifu.catalog import CatalogBuilder
+
+
+def _catalog(*weights):
+    builder = CatalogBuilder()
+    for number, weight in enumerate(weights):
+        builder.add('Waifu {}'.format(number), 'Franchise', weight)
+    return builder.build()
+
+
+def test_effective_weights_default():
+    assert _catalog(1.0, 1.0).effective_weights() is None
+
+
+def test_effective_weights_uniform_positive():
+    catalog = _catalog(2.0, 2.0, 2.0)
+    assert catalog.effective_weights('character') is None
+
+
+def test_effective_weights_some_zero():
+    assert _catalog(0.0, 3.0).effective_weights() == [0.0, 3.0]
+
+
+@pytest.mark.parametrize('mode', ['character', 'franchise'])
+def test_effective_weights_all_zero(mode):
+    catalog = _catalog(0.0, 0.0)
+    with pytest.raises(ValueError):
+        catalog.effective_weights(mode)
+    with pytest.raises(ValueError):
+        catalog.use_weighting(mode)